@@ -26,6 +26,48 @@ async function getCodeDoc(code: string) {
   return { docRef, doc, data: doc.data() };
 }
 
+// Long-poll requests are held open until the code reaches the wanted status or this many seconds pass
+const LONG_POLL_DEFAULT_SECONDS = 25;
+const LONG_POLL_MAX_SECONDS = 50;
+
+function longPollSeconds(timeout: unknown): number {
+  const seconds = Number(timeout);
+  if (!Number.isFinite(seconds) || seconds <= 0) return LONG_POLL_DEFAULT_SECONDS;
+  return Math.min(seconds, LONG_POLL_MAX_SECONDS);
+}
+
+type DocData = FirebaseFirestore.DocumentData;
+
+// Resolves as soon as the code doc satisfies ready (data), times out (null) or disappears (found: false)
+function waitForDoc(code: string, ready: (data: DocData) => boolean, seconds: number) {
+  return new Promise<{ found: boolean; data: DocData | null }>((resolve, reject) => {
+    let unsubscribe = () => {};
+    const finish = (result: { found: boolean; data: DocData | null }) => {
+      clearTimeout(timer);
+      unsubscribe();
+      resolve(result);
+    };
+    const timer = setTimeout(() => finish({ found: true, data: null }), seconds * 1000);
+
+    unsubscribe = db.collection("codes").doc(code).onSnapshot(
+      (snapshot) => {
+        const data = snapshot.data();
+        if (!snapshot.exists || !data) return finish({ found: false, data: null });
+        if (ready(data)) return finish({ found: true, data });
+      },
+      (error) => {
+        clearTimeout(timer);
+        unsubscribe();
+        reject(error);
+      }
+    );
+  });
+}
+
+function waitForStatus(code: string, status: string, seconds: number) {
+  return waitForDoc(code, (data) => data.status === status, seconds);
+}
+
 // --- Functions ---
 
 export const generateCode = functions.https.onRequest((req, res) => {
@@ -177,6 +219,7 @@ export const checkOffer = functions.https.onRequest((req, res) => {
         offer: data.offer,
         candidates: data.candidates,
         metadata: data.metadata || null,
+        revision: data.revision || 0,
       });
     } catch (error) {
       functions.logger.error("Error in checkOffer function:", error);
@@ -185,6 +228,41 @@ export const checkOffer = functions.https.onRequest((req, res) => {
   });
 });
 
+export const waitForOffer = functions.https.onRequest({ timeoutSeconds: LONG_POLL_MAX_SECONDS + 10 }, (req, res) => {
+  cors(req, res, async () => {
+    try {
+      if (req.method !== "POST") return sendError(res, 405, "Method Not Allowed");
+
+      functions.logger.info("Wait For Offer Function: Request body:", { body: req.body });
+      let { code, timeout, since } = req.body;
+      code = (code || "").trim().toUpperCase();
+      since = Number.isInteger(since) ? since : -1;
+
+      if (!isValidCode(code)) return sendError(res, 400, "Invalid or missing code");
+
+      // With `since`, only an offer newer than that revision counts; the desktop waits for re-offers this way
+      const { found, data } = await waitForDoc(
+        code,
+        (data) => data.status === "offered" && (data.revision || 0) > since,
+        longPollSeconds(timeout)
+      );
+
+      if (!found) return sendError(res, 404, "Code not found");
+      if (!data) return res.status(204).send();
+
+      return res.status(200).json({
+        offer: data.offer,
+        candidates: data.candidates,
+        metadata: data.metadata || null,
+        revision: data.revision || 0,
+      });
+    } catch (error) {
+      functions.logger.error("Error in waitForOffer function:", error);
+      return sendError(res, 500, "Internal server error");
+    }
+  });
+});
+
 export const submitAnswer = functions.https.onRequest((req, res) => {
   cors(req, res, async () => {
     try {
@@ -243,6 +321,34 @@ export const checkAnswer = functions.https.onRequest((req, res) => {
   });
 });
 
+export const waitForAnswer = functions.https.onRequest({ timeoutSeconds: LONG_POLL_MAX_SECONDS + 10 }, (req, res) => {
+  cors(req, res, async () => {
+    try {
+      if (req.method !== "POST") return sendError(res, 405, "Method Not Allowed");
+
+      functions.logger.info("Wait For Answer Function: Request body:", { body: req.body });
+
+      let { code, timeout } = req.body;
+      code = (code || "").trim().toUpperCase();
+
+      if (!isValidCode(code)) return sendError(res, 400, "Invalid or missing code");
+
+      const { found, data } = await waitForStatus(code, "answered", longPollSeconds(timeout));
+
+      if (!found) return sendError(res, 404, "Code not found");
+      if (!data) return res.status(204).send();
+
+      return res.status(200).json({
+        answer: data.answer,
+        candidates: data.answerCandidates || [],
+      });
+    } catch (error) {
+      functions.logger.error("Error in waitForAnswer function:", error);
+      return sendError(res, 500, "Internal server error");
+    }
+  });
+});
+
 export const updateOffer = functions.https.onRequest((req, res) => {
   cors(req, res, async () => {
     try {
@@ -257,18 +363,27 @@ export const updateOffer = functions.https.onRequest((req, res) => {
       if (!offer || typeof offer !== "object") return sendError(res, 400, "Missing or invalid SDP offer");
       if (!Array.isArray(candidates)) return sendError(res, 400, "Missing or invalid ICE candidates");
 
-      const { docRef, doc } = await getCodeDoc(code);
+      const { docRef, doc, data } = await getCodeDoc(code);
 
-      if (!doc.exists) return sendError(res, 404, "Code not found");
+      if (!doc.exists || !data) return sendError(res, 404, "Code not found");
+      if (data.status === "waiting") return sendError(res, 409, "No offer to update, use submitOffer");
 
+      // A re-offer on an already paired code: the desktop answers it with a fresh peer connection,
+      // so the previous answer and trickled candidates no longer apply
+      const revision = (data.revision || 0) + 1;
       await docRef.update({
         offer,
         candidates,
+        candidatesComplete: false,
+        answer: admin.firestore.FieldValue.delete(),
+        answerCandidates: admin.firestore.FieldValue.delete(),
         metadata: metadata || null,
+        status: "offered",
+        revision,
         updatedAt: admin.firestore.FieldValue.serverTimestamp(),
       });
 
-      return res.status(200).json({ success: true, message: "Offer updated successfully" });
+      return res.status(200).json({ success: true, message: "Offer updated successfully", revision });
     } catch (error) {
       functions.logger.error("Error in updateOffer function:", error);
       return sendError(res, 500, "Internal server error");
@@ -276,6 +391,70 @@ export const updateOffer = functions.https.onRequest((req, res) => {
   });
 });
 
+export const addCandidates = functions.https.onRequest((req, res) => {
+  cors(req, res, async () => {
+    try {
+      if (req.method !== "POST") return sendError(res, 405, "Method Not Allowed");
+
+      functions.logger.info("Add Candidates Function: Request body:", { body: req.body });
+
+      let { code, candidates, complete } = req.body;
+      code = (code || "").trim().toUpperCase();
+
+      if (!isValidCode(code)) return sendError(res, 400, "Invalid code format");
+      if (!Array.isArray(candidates)) return sendError(res, 400, "Missing or invalid ICE candidates");
+
+      const { docRef, doc } = await getCodeDoc(code);
+
+      if (!doc.exists) return sendError(res, 404, "Code not found");
+
+      const update: { [field: string]: any } = {
+        updatedAt: admin.firestore.FieldValue.serverTimestamp(),
+      };
+      if (candidates.length > 0) update.candidates = admin.firestore.FieldValue.arrayUnion(...candidates);
+      if (complete) update.candidatesComplete = true;
+      await docRef.update(update);
+
+      return res.status(200).json({ success: true, message: "ICE candidates added" });
+    } catch (error) {
+      functions.logger.error("Error in addCandidates function:", error);
+      return sendError(res, 500, "Internal server error");
+    }
+  });
+});
+
+export const waitForCandidates = functions.https.onRequest({ timeoutSeconds: LONG_POLL_MAX_SECONDS + 10 }, (req, res) => {
+  cors(req, res, async () => {
+    try {
+      if (req.method !== "POST") return sendError(res, 405, "Method Not Allowed");
+
+      let { code, since, timeout } = req.body;
+      code = (code || "").trim().toUpperCase();
+      since = Number.isInteger(since) && since > 0 ? since : 0;
+
+      if (!isValidCode(code)) return sendError(res, 400, "Invalid or missing code");
+
+      // Returns the candidates after index `since` as soon as there are any, or once the offerer is done gathering
+      const { found, data } = await waitForDoc(
+        code,
+        (data) => (data.candidates || []).length > since || !!data.candidatesComplete,
+        longPollSeconds(timeout)
+      );
+
+      if (!found) return sendError(res, 404, "Code not found");
+      if (!data) return res.status(204).send();
+
+      return res.status(200).json({
+        candidates: (data.candidates || []).slice(since),
+        complete: !!data.candidatesComplete,
+      });
+    } catch (error) {
+      functions.logger.error("Error in waitForCandidates function:", error);
+      return sendError(res, 500, "Internal server error");
+    }
+  });
+});
+
 export const getTurnCredentials = functions.https.onRequest(async (req, res) => {
   cors(req, res, async () => {
     try {
@@ -1,24 +1,89 @@
 #!/usr/bin/env python3
-import sys
-import requests
-import asyncio
+# Taken before anything else loads, so --profile-startup covers every import below
 import time
-import random
+STARTED_AT = time.perf_counter()
+
+import sys
+import argparse
+import importlib
+import os
+import logging
+import threading
 from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QWidget, QHBoxLayout, QVBoxLayout,
-    QPushButton, QFrame, QLabel, QSizePolicy, QSpacerItem,
-    QSystemTrayIcon, QMenu, QAction
+    QApplication, QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QGridLayout,
+    QPushButton, QLabel, QSizePolicy, QSpacerItem,
+    QSystemTrayIcon, QMenu
 )
-from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QIcon
-from webrtc_pipeline import WebRTCWorker
+
+logger = logging.getLogger(__name__)
+
+# Only PyQt is imported up front so the window paints right away. These load in the
+# background: signaling (aiohttp) once the window is up, the streaming stack (aiortc,
+# PyAV, numpy, OpenCV, GStreamer) once a code has been generated and a phone is on its way.
+SIGNALING_MODULES = ("signaling",)
+STREAMING_MODULES = ("session_manager", "webrtc_pipeline", "audio_pipeline", "recorder")
+
+def preload(modules, then=None):
+    # A GUI-thread import of a module that's still loading here waits for it rather than loading it twice
+    def run():
+        started = time.perf_counter()
+        for name in modules:
+            importlib.import_module(name)
+        if then:
+            then()
+        logger.info("Preloaded %s in %.0f ms", ", ".join(modules), (time.perf_counter() - started) * 1000)
+    threading.Thread(target=run, daemon=True, name="preload").start()
+
+def prewarm_streaming():
+    import webrtc_pipeline
+    webrtc_pipeline.prewarm()
 
 class PixelStreamerApp(QMainWindow):
-    def __init__(self):
+    def __init__(self, options=None):
         super().__init__()
+        self.options = options or parse_args([])
         self.code = None
         self.preview_frame = None
+        self.webcam_enabled = True
+        self.microphone_enabled = True
+        self.signaling = None
+        self.manager = None
+        self.streaming_preloaded = False
+        self.session_states = {}
+        self.session_stats = {}
+        self.tiles = {}
+        self.metrics_server = None
         self.initUI()
+        preload(SIGNALING_MODULES)
+        if self.options.metrics_port:
+            QTimer.singleShot(0, self.start_metrics_server)
+
+    def signaling_bridge(self):
+        if self.signaling is None:
+            from signaling import QtSignalingBridge
+            self.signaling = QtSignalingBridge()
+            self.signaling.code_generated.connect(self.on_code_generated)
+            self.signaling.code_failed.connect(self.on_code_failed)
+            self.signaling.offer_received.connect(self.on_offer_received)
+        return self.signaling
+
+    def session_manager(self):
+        if self.manager is None:
+            from session_manager import SessionManager
+            self.manager = SessionManager(self.options.loop_pool_size)
+            self.manager.session_state_changed.connect(self.update_connection_status)
+            self.manager.session_metrics_updated.connect(self.update_stats)
+        return self.manager
+
+    def workers(self):
+        return self.manager.workers() if self.manager else []
+
+    def start_metrics_server(self):
+        from metrics import MetricsServer
+        self.metrics_server = MetricsServer(port=self.options.metrics_port)
+        self.signaling_bridge().submit(self.metrics_server.start())
 
     def initUI(self):
         self.setWindowTitle("PixelStreamer")
@@ -99,11 +164,22 @@ class PixelStreamerApp(QMainWindow):
         self.preview_frame.setMinimumSize(600, 400)
         self.preview_frame.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
-        # Create a layout for the preview frame to hold the GStreamer video widget
-        self.preview_layout = QVBoxLayout()
+        # One tile per connected phone, laid out in a grid inside the preview frame
+        self.preview_layout = QGridLayout()
+        self.preview_layout.setSpacing(10)
         self.preview_frame.setLayout(self.preview_layout)
 
+        self.stats_label = QLabel("")
+        self.stats_label.setStyleSheet("""
+            QLabel {
+                color: #AAAAAA;
+                font-size: 30px;
+            }
+        """)
+        self.stats_label.setAlignment(Qt.AlignLeft)
+
         preview_container.addWidget(preview_label)
+        preview_container.addWidget(self.stats_label)
         preview_container.addWidget(self.preview_frame)
 
         main_layout.addWidget(sidebar)
@@ -115,8 +191,8 @@ class PixelStreamerApp(QMainWindow):
 
         tray_menu = QMenu()
         tray_menu.addAction("Generate Code", self.show_main_window)
-        tray_menu.addAction("Toggle Camera", self.show_main_window)
-        tray_menu.addAction("Toggle Microphone", self.show_main_window)
+        tray_menu.addAction("Toggle Camera", self.toggle_virtual_camera)
+        tray_menu.addAction("Toggle Microphone", self.toggle_microphone)
         tray_menu.addAction("Show", self.show_main_window)
         tray_menu.addAction("Quit", QApplication.quit)
 
@@ -127,6 +203,24 @@ class PixelStreamerApp(QMainWindow):
         self.show()
         self.raise_()
         self.activateWindow()
+        self.set_preview_enabled(True)
+
+    def set_preview_enabled(self, enabled):
+        for worker in self.workers():
+            worker.gst_pipeline.set_preview_enabled(enabled)
+
+    def toggle_virtual_camera(self):
+        self.webcam_enabled = not self.webcam_enabled
+        for worker in self.workers():
+            worker.gst_pipeline.set_virtual_camera_enabled(self.webcam_enabled)
+        logger.info("Virtual camera %s", "enabled" if self.webcam_enabled else "paused")
+
+    def toggle_microphone(self):
+        self.microphone_enabled = not self.microphone_enabled
+        for worker in self.workers():
+            if worker.audio_pipeline:
+                worker.audio_pipeline.set_muted(not self.microphone_enabled)
+        logger.info("Microphone %s", "enabled" if self.microphone_enabled else "muted")
 
     def on_button_click(self, button):
         if button.text() == self.buttons[0] or button.text() == "Error":
@@ -141,66 +235,171 @@ class PixelStreamerApp(QMainWindow):
             return
         if button.text() == self.buttons[1]:
             self.hide()
+            self.set_preview_enabled(False)
+            return
+        if button.text() == self.buttons[2]:
+            self.toggle_virtual_camera()
+            return
+        if button.text() == self.buttons[3]:
+            self.toggle_microphone()
             return
 
     def handle_code_generation(self, button):
-        self.code = self.request_code()
-        button.setText(self.code)
-        button.setEnabled(True)
-        if self.code != "Error":
-            self.poll_for_offer()
-
-    def request_code(self):
-        try:
-            response = requests.post("https://generatecode-qaf2yvcrrq-uc.a.run.app")
-            response.raise_for_status()
-            return response.json()['code']
-        except Exception as e:
-            print(f"Failed to generate code: {e}")
-            return "Error"
-
-    def poll_for_offer(self):
-        self.poll_attempt = 0
-        self.max_attempts = 30
-        self.base_delay = 1.0
-        self.max_delay = 30.0
-        self.poll_timer = QTimer()
-        self.poll_timer.setSingleShot(True)
-
-        def poll():
-            print(f"[Polling] Attempt {self.poll_attempt + 1}")
-            try:
-                response = requests.post("https://checkoffer-qaf2yvcrrq-uc.a.run.app", json={"code": self.code}, timeout=5)
-                if response.status_code == 200:
-                    print("✅ Offer received! Starting connection thread...")
-                    win_id = int(self.preview_frame.winId())
-                    self.worker = WebRTCWorker(code=self.code, widget_win_id=win_id, offer=response.json()["offer"])
-                    self.worker.connection_state_changed.connect(self.update_connection_status)
-                    self.worker.start()
-                    return
-                elif response.status_code == 204:
-                    print("🕐 Not ready yet...")
-                else:
-                    print(f"⚠️ Unexpected status: {response.status_code}")
-            except Exception as e:
-                print(f"❌ Poll error: {e}")
-
-            self.poll_attempt += 1
-            if self.poll_attempt >= self.max_attempts:
-                print("⛔ Gave up waiting for offer.")
-                return
-
-            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** self.poll_attempt)))
-            print(f"🔁 Retrying in {delay:.2f} seconds...")
-            self.poll_timer.start(int(delay * 1000))
-
-        self.poll_timer.timeout.connect(poll)
-        poll()
-
-    def update_connection_status(self, state):
-        print(f"Connection state update: {state}")
+        self.code_button = button
+        self.signaling_bridge().request_code()
+
+    def on_code_generated(self, code):
+        self.code = code
+        self.code_button.setText(code)
+        self.code_button.setEnabled(True)
+        self.signaling.poll_for_offer(code)
+        if not self.streaming_preloaded:
+            # The phone takes a few seconds to scan the code and send its offer; use them
+            self.streaming_preloaded = True
+            preload(STREAMING_MODULES, then=prewarm_streaming)
+
+    def on_code_failed(self, error):
+        self.code = None
+        self.code_button.setText("Error")
+        self.code_button.setEnabled(True)
+
+    def on_offer_received(self, code, offer):
+        if code != self.code:
+            return
+        logger.info("✅ Offer received for %s! Starting session...", code)
+        # The session owns the code from here on; free the button so another phone can pair
+        self.code = None
+        self.code_button.setText(self.buttons[0])
+        self.code_button.setEnabled(True)
+
+        from session_manager import numbered_device
+        manager = self.session_manager()
+        index = manager.free_index()
+        tile = self.add_tile(code)
+        manager.start_session(
+            code,
+            offer,
+            int(tile.winId()),
+            index=index,
+            recorder=self.create_recorder(code, index),
+            record_path=session_path(self.options.record_video, code, index),
+            virtual_device=numbered_device(self.options.virtual_device, index),
+            virtual_sink=self.options.virtual_sink,
+            metrics_server=self.metrics_server,
+            audio_pipeline=self.create_audio_pipeline(index),
+            codecs=self.options.codecs,
+            decode=self.options.decode,
+            h264_decoder=self.options.h264_decoder,
+            adaptive_quality=not self.options.no_adaptive_quality,
+            # Start from what the window and tray currently say, like the sessions already running
+            preview_enabled=self.isVisible(),
+            virtual_camera_enabled=self.webcam_enabled,
+        )
+
+    def add_tile(self, code):
+        # Native child window the video sink draws into directly; Qt must not paint over it
+        tile = QWidget()
+        tile.setAttribute(Qt.WA_NativeWindow)
+        tile.setAttribute(Qt.WA_NoSystemBackground)
+        tile.setAttribute(Qt.WA_OpaquePaintEvent)
+        tile.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.tiles[code] = tile
+        self.layout_tiles()
+        return tile
+
+    def remove_tile(self, code):
+        tile = self.tiles.pop(code, None)
+        if tile is None:
+            return
+        self.preview_layout.removeWidget(tile)
+        tile.deleteLater()
+        self.layout_tiles()
+
+    def layout_tiles(self):
+        columns = 1
+        while columns * columns < len(self.tiles):
+            columns += 1
+        for i, tile in enumerate(self.tiles.values()):
+            self.preview_layout.addWidget(tile, i // columns, i % columns)
+
+    def end_session(self, code):
+        # Closing the peer connection reports "closed" again, so only tear down once
+        if code in self.manager.sessions:
+            self.manager.stop_session(code)
+            self.signaling.delete_code(code)
+        self.remove_tile(code)
+        self.session_states.pop(code, None)
+        self.session_stats.pop(code, None)
+
+    def create_audio_pipeline(self, index=0):
+        if self.options.no_audio:
+            return None
+        from audio_pipeline import AudioPipeline, VirtualMicrophone
+        microphone = None
+        if not self.options.audio_sink:
+            microphone = VirtualMicrophone(name=f"pixelstreamer_mic{index or ''}",
+                                           description=f"PixelStreamer{index + 1 if index else ''}")
+        audio = AudioPipeline(sink=self.options.audio_sink, microphone=microphone, av_offset_ms=self.options.av_offset)
+        audio.set_muted(not self.microphone_enabled)
+        return audio
+
+    def create_recorder(self, code, index=0):
+        if not self.options.record_dir:
+            return None
+        from recorder import FrameRecorder
+        return FrameRecorder(
+            directory=self.options.record_dir if index == 0 else os.path.join(self.options.record_dir, code),
+            policy=self.options.record_policy,
+            every_nth=self.options.record_every,
+        )
+
+    def update_stats(self, code, snapshot):
+        peer = snapshot["peer"]
+        frames = snapshot["frames"]
+        render = snapshot["stages"].get("render", {})
+        parts = [f"{frames.get('render_delivered', 0)} rendered / {frames.get('render_dropped', 0)} dropped"]
+        if peer.get("bitrate_kbps") is not None:
+            parts.append(f"{peer['bitrate_kbps']:.0f} kbps")
+        if peer.get("jitter_ms") is not None:
+            parts.append(f"jitter {peer['jitter_ms']:.1f} ms")
+        parts.append(f"loss {peer.get('loss_rate', 0):.1%}")
+        if peer.get("rtt_ms") is not None:
+            parts.append(f"RTT {peer['rtt_ms']:.0f} ms")
+        if render:
+            parts.append(f"render p99 {render['p99_ms']:.1f} ms")
+        quality = snapshot.get("quality", {})
+        if quality.get("scaleResolutionDownBy", 1) > 1 or quality.get("maxFramerate"):
+            limits = [f"1/{quality['scaleResolutionDownBy']:g} res"]
+            if quality.get("maxFramerate"):
+                limits.append(f"{quality['maxFramerate']} fps")
+            parts.append("phone limited to " + ", ".join(limits))
+        self.session_stats[code] = "  ·  ".join(parts)
+        if len(self.session_stats) == 1:
+            self.stats_label.setText(self.session_stats[code])
+        else:
+            self.stats_label.setText("\n".join(f"{c}: {text}" for c, text in self.session_stats.items()))
+
+    def update_connection_status(self, code, state):
+        logger.info("Connection state update for %s: %s", code, state)
+        if state in ("failed", "closed"):
+            self.end_session(code)
+        else:
+            self.session_states[code] = state
+
+        # Summarise every session in the one status label
+        states = list(self.session_states.values())
+        connected = states.count("connected")
+        if connected:
+            state = "connected"
+        elif "reconnecting" in states:
+            state = "reconnecting"
+        elif "connecting" in states:
+            state = "connecting"
+        elif "disconnected" in states:
+            state = "disconnected"
+
         if state == "connected":
-            self.connection_status.setText("Connection: Connected")
+            self.connection_status.setText("Connection: Connected" + (f" ({connected})" if connected > 1 else ""))
             self.connection_status.setStyleSheet("""
                 QLabel {
                     color: #2ECC71;
@@ -208,8 +407,9 @@ class PixelStreamerApp(QMainWindow):
                     font-weight: bold;
                 }
             """)
-        elif state == "connecting":
-            self.connection_status.setText("Connection: Connecting...")
+        elif state == "connecting" or state == "reconnecting":
+            # Reconnecting keeps the session, its preview tile and virtual devices while the phone re-offers
+            self.connection_status.setText(f"Connection: {state.capitalize()}...")
             self.connection_status.setStyleSheet("""
                 QLabel {
                     color: #F39C12;
@@ -232,25 +432,90 @@ class PixelStreamerApp(QMainWindow):
         button.setText(self.buttons[0])
         button.setEnabled(True)
 
-    def delete_code(self):
-        try:
-            if self.code is None:
-                return
-                
-            requests.post("https://deletecode-qaf2yvcrrq-uc.a.run.app", json={"code": self.code})
-            self.code = None
-        except Exception as e:
-            print(f"Failed to delete code: {e}")
+    def delete_code(self, wait=False):
+        if self.code is None:
+            return
+        self.signaling.delete_code(self.code, wait=wait)
+        self.code = None
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # The sink doesn't watch the window itself, so redraw at the new size
+        for worker in self.workers():
+            worker.gst_pipeline.expose()
 
     def closeEvent(self, event):
-        self.delete_code()
+        self.delete_code(wait=True)
+        if self.manager:
+            for code in list(self.manager.sessions):
+                self.signaling.delete_code(code, wait=True)
+            self.manager.stop()
+        if self.signaling:
+            self.signaling.close()
         event.accept()
 
 
+def session_path(path, code, index):
+    # The first session records where asked; later ones get the code prefixed to the file name
+    if not path or index == 0:
+        return path
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f"{code}_{name}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="PixelStreamer desktop app")
+    parser.add_argument("--record-dir", help="Save received frames as JPEGs into this directory")
+    parser.add_argument("--record-policy", default="drop-oldest",
+                        help="Which frames to keep when the JPEG writers fall behind: drop-oldest, keyframe-only or every-nth")
+    parser.add_argument("--record-every", type=int, default=5, help="Frame interval for the every-nth policy")
+    parser.add_argument("--record-video", help="Record an H.264 segmented file, e.g. recordings/stream_%%05d.mkv")
+    parser.add_argument("--virtual-device", default="/dev/video10",
+                        help="v4l2loopback device to expose the stream on as a webcam")
+    parser.add_argument("--virtual-sink",
+                        help="GStreamer sink to use instead of v4l2sink, e.g. fakesink or 'filesink location=out.yuv'")
+    parser.add_argument("--no-audio", action="store_true", help="Ignore the phone's microphone track")
+    parser.add_argument("--audio-sink",
+                        help="GStreamer sink to use instead of the virtual microphone, e.g. fakesink or 'wavenc ! filesink location=mic.wav'")
+    parser.add_argument("--av-offset", type=int, default=0,
+                        help="Milliseconds to delay audio by to line it up with the video path; nothing syncs them otherwise")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics (and /metrics.json)")
+    parser.add_argument("--codecs", nargs="+", metavar="CODEC",
+                        help="Video codecs to prefer in the answer, best first, e.g. --codecs H264 VP8")
+    parser.add_argument("--decode", choices=["software", "gstreamer"], default="software",
+                        help="Decode H.264 in GStreamer (VA-API when available) instead of in aiortc")
+    parser.add_argument("--h264-decoder", help="GStreamer H.264 decoder to use with --decode gstreamer, e.g. avdec_h264")
+    parser.add_argument("--no-adaptive-quality", action="store_true",
+                        help="Don't ask the phone to lower resolution or frame rate when the desktop or network falls behind")
+    parser.add_argument("--loop-pool-size", type=int,
+                        help="Event loops shared by all phone sessions (default: one per two CPU cores, up to 4)")
+    parser.add_argument("--tray", action="store_true", help="Start hidden in the system tray, e.g. when autostarted at login")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Print how long the window took to show, then quit (see profile_startup.py)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args, _ = parser.parse_known_args(argv)
+    if args.record_dir:
+        # Checked here rather than with choices= so parsing doesn't pull in OpenCV for everyone
+        from recorder import DROP_POLICIES
+        if args.record_policy not in DROP_POLICIES:
+            parser.error(f"--record-policy must be one of {', '.join(DROP_POLICIES)}")
+    return args
+
+
 def main():
+    options = parse_args(sys.argv[1:])
+    logging.basicConfig(level=options.log_level, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
     app = QApplication(sys.argv)
-    window = PixelStreamerApp()
-    window.show()
+    window = PixelStreamerApp(options)
+    if not options.tray:
+        window.show()
+    if options.profile_startup:
+        # Fires once the event loop is idle, i.e. after the first paint
+        def report():
+            print(f"startup: window ready after {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms", flush=True)
+            app.quit()
+        QTimer.singleShot(0, report)
     sys.exit(app.exec_())
 
 
@@ -0,0 +1,135 @@
+import logging
+import shutil
+import subprocess
+import gi
+from av import AudioFrame, AudioResampler
+
+gi.require_version("Gst", "1.0")
+from gi.repository import Gst
+
+Gst.init(None)
+
+logger = logging.getLogger(__name__)
+
+# Opus decodes to 48kHz; the virtual mic runs at the same rate so audioresample stays in passthrough
+OUTPUT_RATE = 48000
+
+# av sample formats that can be handed to appsrc as-is
+NATIVE_FORMATS = {
+  "s16": "S16LE",
+  "s32": "S32LE",
+  "flt": "F32LE",
+}
+
+# Creates a PulseAudio/PipeWire null sink and exposes its monitor as a regular
+# input device, so other apps can pick the phone's microphone like any other mic.
+class VirtualMicrophone:
+  def __init__(self, name="pixelstreamer_mic", description="PixelStreamer"):
+    self.name = name
+    self.description = description
+    self.module_ids = []
+
+  def load_module(self, *args):
+    out = subprocess.run(["pactl", "load-module", *args], capture_output=True, text=True, check=True)
+    self.module_ids.append(out.stdout.strip())
+
+  def create(self):
+    if shutil.which("pactl") is None:
+      logger.warning("pactl not found, virtual microphone unavailable")
+      return False
+    try:
+      self.load_module("module-null-sink", f"sink_name={self.name}",
+                       f"sink_properties=device.description={self.description}-Sink")
+      self.load_module("module-remap-source", f"master={self.name}.monitor", f"source_name={self.name}_source",
+                       f"source_properties=device.description={self.description}")
+    except subprocess.CalledProcessError as e:
+      logger.error("Failed to create virtual microphone: %s", e.stderr.strip())
+      self.remove()
+      return False
+    return True
+
+  def remove(self):
+    for module_id in reversed(self.module_ids):
+      subprocess.run(["pactl", "unload-module", module_id], capture_output=True)
+    self.module_ids = []
+
+class AudioPipeline:
+  def __init__(self, sink: str = None, microphone: VirtualMicrophone = None,
+               latency_ms: int = 20, av_offset_ms: int = 0):
+    self.sink = sink
+    self.microphone = microphone
+    self.latency_ms = latency_ms
+    self.av_offset_ms = av_offset_ms
+    self.pipeline = None
+    self.appsrc = None
+    self.volume = None
+    self.caps_key = None
+    self.resampler = None
+    self.muted = False
+
+  def sink_description(self):
+    if self.sink:
+      return self.sink
+    # Small buffers keep the mic close to real time; ts-offset shifts audio to line up with the video path
+    latency_us = self.latency_ms * 1000
+    device = f"device={self.microphone.name} " if self.microphone else ""
+    return (f"pulsesink {device}buffer-time={latency_us * 2} latency-time={latency_us} "
+            f"ts-offset={self.av_offset_ms * Gst.MSECOND} provide-clock=false")
+
+  def build_pipeline(self):
+    # Blocks on pactl when it creates the virtual microphone; call it off the event loop
+    if self.microphone and not self.sink and not self.microphone.module_ids:
+      self.microphone.create()
+
+    pipeline_description = f"""
+      appsrc name=audiosrc is-live=true format=time do-timestamp=true !
+      audioconvert !
+      audioresample !
+      audio/x-raw,rate={OUTPUT_RATE} !
+      volume name=volume mute={str(self.muted).lower()} !
+      queue max-size-time={self.latency_ms * 4 * Gst.MSECOND} max-size-buffers=0 max-size-bytes=0 leaky=downstream !
+      {self.sink_description()}
+    """
+    # Audio and video aren't synchronised: each pipeline stamps buffers on arrival against its
+    # own base time and the video sinks don't sync at all. --av-offset is the manual alignment.
+    self.pipeline = Gst.parse_launch(pipeline_description)
+    self.appsrc = self.pipeline.get_by_name("audiosrc")
+    self.volume = self.pipeline.get_by_name("volume")
+    self.pipeline.set_state(Gst.State.PLAYING)
+
+  def set_caps(self, fmt, rate, channels):
+    if self.caps_key == (fmt, rate, channels):
+      return
+    caps = f"audio/x-raw,format={fmt},layout=interleaved,rate={rate},channels={channels}"
+    self.appsrc.set_caps(Gst.Caps.from_string(caps))
+    self.caps_key = (fmt, rate, channels)
+
+  def push_audio_frame(self, frame: AudioFrame):
+    fmt = NATIVE_FORMATS.get(frame.format.name)
+    if fmt is None:
+      # Planar formats are rare from aiortc; interleave them in one libswresample pass
+      if self.resampler is None:
+        self.resampler = AudioResampler(format="s16", layout=frame.layout.name, rate=frame.sample_rate)
+      for converted in self.resampler.resample(frame):
+        self.push_audio_frame(converted)
+      return
+
+    channels = len(frame.layout.channels)
+    self.set_caps(fmt, frame.sample_rate, channels)
+    # Packed formats keep every sample in the first plane; trim the allocator's padding
+    size = frame.samples * channels * frame.format.bytes
+    self.appsrc.emit("push-buffer", Gst.Buffer.new_wrapped(bytes(memoryview(frame.planes[0])[:size])))
+
+  def set_muted(self, muted: bool):
+    self.muted = muted
+    if self.volume:
+      self.volume.set_property("mute", muted)
+
+  def stop(self):
+    if self.pipeline:
+      self.pipeline.set_state(Gst.State.NULL)
+      self.pipeline = None
+    self.caps_key = None
+    self.resampler = None
+    if self.microphone:
+      self.microphone.remove()
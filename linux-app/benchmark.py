@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# Headless streaming benchmark. Pairs a local aiortc sender (standing in for the
+# phone) with WebRTCWorker over loopback through the local signaling server, then
+# reports connection setup time, time-to-first-frame, glass-to-glass latency (stamped
+# into each frame, read back at the pipeline's sink), achieved fps, drop rate and CPU
+# per frame for each resolution.
+#
+#   python3 benchmark.py --resolutions 640x360 1280x720 1920x1080 --duration 10 --json bench.json
+import argparse
+import asyncio
+import json
+import os
+import re
+import threading
+from fractions import Fraction
+import time
+import gi
+import numpy as np
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from av import VideoFrame
+from PyQt5.QtCore import Qt
+from signaling import SignalingClient
+from signaling_server import SignalingServer
+from session_manager import EventLoopPool
+from video_codecs import negotiated_codec
+from webrtc_pipeline import WebRTCWorker
+
+gi.require_version("Gst", "1.0")
+gi.require_version("GstVideo", "1.0")
+from gi.repository import Gst, GstVideo
+
+VIDEO_CLOCK_RATE = 90000
+
+# Each frame carries a 64-bit stamp drawn as two rows of 32 black/white blocks in the
+# luma plane: 16-bit sequence number, 40-bit send time in microseconds, 8-bit checksum.
+# Big high-contrast blocks survive the encoder at every resolution we test.
+STAMP_BLOCKS = 32
+TIMESTAMP_MASK = (1 << 40) - 1
+
+def now_us():
+  return time.time_ns() // 1000
+
+def stamp_bits(seq, timestamp):
+  value = ((seq & 0xFFFF) << 40) | (timestamp & TIMESTAMP_MASK)
+  payload = value.to_bytes(7, "big")
+  value = (value << 8) | (sum(payload) & 0xFF)
+  return [(value >> (63 - i)) & 1 for i in range(64)]
+
+def read_stamp(plane, width, pixel_stride=1):
+  # plane is the first plane as rows of bytes: luma for YUV, interleaved channels for RGB,
+  # where the first channel of a black or white block reads the same
+  block = width // STAMP_BLOCKS
+  value = 0
+  for i in range(64):
+    row, col = divmod(i, STAMP_BLOCKS)
+    value = (value << 1) | int(plane[row * block + block // 2, (col * block + block // 2) * pixel_stride] > 128)
+  payload = (value >> 8).to_bytes(7, "big")
+  if sum(payload) & 0xFF != value & 0xFF:
+    return None
+  return (value >> 48) & 0xFFFF, (value >> 8) & TIMESTAMP_MASK
+
+def gradient(width, height):
+  # Static gradient behind the stamp so the encoder has some real content to chew on
+  base = np.full((height * 3 // 2, width), 128, np.uint8)
+  base[:height] = np.linspace(16, 235, width, dtype=np.uint8)
+  return base
+
+# Stands in for the phone's camera, including how the PWA applies the desktop's quality targets
+class SyntheticVideoTrack(VideoStreamTrack):
+  def __init__(self, width, height, fps):
+    super().__init__()
+    self.full_size = (width, height)
+    self.full_fps = fps
+    self.width = width
+    self.height = height
+    self.fps = fps
+    self.seq = 0
+    self.start = None
+    self.next_at = None
+    self.targets = []
+    self.base = gradient(width, height)
+
+  def resumed(self):
+    # aiortc stops a track along with its connection; carry on the same stream on a new one
+    track = SyntheticVideoTrack(*self.full_size, self.full_fps)
+    track.seq = self.seq
+    if self.targets:
+      track.apply_target(self.targets[-1])
+    return track
+
+  def apply_target(self, target):
+    self.targets.append(target)
+    scale = target.get("scaleResolutionDownBy") or 1
+    # Even dimensions, as a real encoder would pick
+    self.width = int(self.full_size[0] / scale) // 2 * 2
+    self.height = int(self.full_size[1] / scale) // 2 * 2
+    self.fps = min(self.full_fps, target.get("maxFramerate") or self.full_fps)
+    self.base = gradient(self.width, self.height)
+
+  async def recv(self):
+    now = time.time()
+    if self.next_at is None:
+      self.start = self.next_at = now
+    elif self.next_at > now:
+      await asyncio.sleep(self.next_at - now)
+    pts = int((self.next_at - self.start) * VIDEO_CLOCK_RATE)
+    self.next_at += 1 / self.fps
+
+    img = self.base.copy()
+    block = self.width // STAMP_BLOCKS
+    for i, bit in enumerate(stamp_bits(self.seq, now_us())):
+      row, col = divmod(i, STAMP_BLOCKS)
+      img[row * block:(row + 1) * block, col * block:(col + 1) * block] = 235 if bit else 16
+
+    frame = VideoFrame.from_ndarray(img, format="yuv420p")
+    frame.pts = pts
+    frame.time_base = Fraction(1, VIDEO_CLOCK_RATE)
+    self.seq += 1
+    return frame
+
+# Reads the stamp off every buffer reaching the headless preview sink, on its streaming
+# thread, so the latency covers the render thread's copy and the GStreamer path too
+class LatencyProbe:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.first_frame_at = None
+    self.last_seq = None
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.latencies_ms = []
+      self.sequences = set()
+      self.undecodable = 0
+
+  def attach(self, sink):
+    sink.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_buffer)
+
+  def on_buffer(self, pad, probe_info):
+    received = now_us()
+    buf = probe_info.get_buffer()
+    info = GstVideo.VideoInfo.new_from_caps(pad.get_current_caps())
+    ok, mapinfo = buf.map(Gst.MapFlags.READ)
+    if ok:
+      try:
+        stride = info.stride[0]
+        plane = np.frombuffer(mapinfo.data, np.uint8, count=stride * info.height, offset=info.offset[0])
+        self.record(received, read_stamp(plane.reshape(info.height, stride), info.width, info.finfo.pixel_stride[0]))
+      finally:
+        buf.unmap(mapinfo)
+    return Gst.PadProbeReturn.OK
+
+  def record(self, received, stamp):
+    with self.lock:
+      if self.first_frame_at is None:
+        self.first_frame_at = time.perf_counter()
+      if stamp is None:
+        self.undecodable += 1
+        return
+      seq, sent = stamp
+      self.last_seq = seq
+      self.sequences.add(seq)
+      self.latencies_ms.append(((received - sent) & TIMESTAMP_MASK) / 1000)
+
+def split_candidates(sdp):
+  # Pulls the candidate lines out of an aiortc offer so they can be trickled like the PWA does
+  lines, candidates = [], []
+  mline_index, mid = -1, None
+  for line in sdp.splitlines():
+    if line.startswith("m="):
+      mline_index += 1
+      mid = None
+    elif line.startswith("a=mid:"):
+      mid = line[len("a=mid:"):]
+    if line.startswith("a=candidate:"):
+      candidates.append({"candidate": line[2:], "sdpMLineIndex": mline_index, "mid": mid})
+      continue
+    if line == "a=end-of-candidates":
+      continue
+    lines.append(line)
+  for candidate in candidates:
+    candidate["sdpMid"] = candidate.pop("mid") or str(candidate["sdpMLineIndex"])
+  return "\r\n".join(lines) + "\r\n", candidates
+
+def percentile(values, pct):
+  if not values:
+    return float("nan")
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+async def wait_until(predicate, timeout):
+  deadline = time.perf_counter() + timeout
+  while not predicate():
+    if time.perf_counter() > deadline:
+      return False
+    await asyncio.sleep(0.005)
+  return True
+
+def simulate_render_load(worker, load_ms):
+  # Extra render time per frame, scaled by pixel count relative to 720p, so a lower
+  # resolution from the phone really does relieve the pressure
+  push = worker.gst_pipeline.push_video_frame
+
+  def slow_push(frame):
+    time.sleep(load_ms / 1000 * frame.width * frame.height / (1280 * 720))
+    push(frame)
+
+  worker.gst_pipeline.push_video_frame = slow_push
+
+def handle_control(channel, track, message):
+  # Same as the PWA: echo pings for the RTT, apply quality targets to the encoder
+  if message.get("type") == "ping":
+    channel.send(json.dumps({**message, "type": "pong"}))
+  elif message.get("type") == "quality":
+    track.apply_target(message)
+
+async def connect_sender(client, code, track, trickle, reoffer=False):
+  sender = RTCPeerConnection()
+  sender.addTrack(track)
+  control = sender.createDataChannel("control")
+  control.on("message", lambda message: handle_control(control, track, json.loads(message)))
+
+  await sender.setLocalDescription(await sender.createOffer())
+  offer = {"sdp": sender.localDescription.sdp, "type": sender.localDescription.type}
+  candidates = []
+  if trickle:
+    offer["sdp"], candidates = split_candidates(offer["sdp"])
+  if reoffer:
+    await client.update_offer(code, offer)
+  else:
+    await client.submit_offer(code, offer)
+  if candidates:
+    await client.add_candidates(code, candidates, complete=True)
+  return sender
+
+async def measure_reconnect(client, code, sender, track, probe, trickle):
+  # Drops the sender's connection and re-offers on the same code, as the PWA does after a
+  # Wi-Fi roam. Returns the time until frames sent on the new connection reach the worker.
+  await sender.close()
+  track = track.resumed()
+  first_seq = track.seq
+  started = time.perf_counter()
+  sender = await connect_sender(client, code, track, trickle, reoffer=True)
+  answer = None
+  while answer is None:
+    answer = await client.wait_for_answer(code, 5)
+  await sender.setRemoteDescription(RTCSessionDescription(**answer["answer"]))
+  resumed = await wait_until(lambda: probe.last_seq is not None and probe.last_seq >= first_seq, 10)
+  reconnect_ms = (time.perf_counter() - started) * 1000 if resumed else float("nan")
+  return sender, track, reconnect_ms
+
+async def run_scenario(base_url, width, height, fps, duration, trickle, pool=None, codecs=None, load_ms=0,
+                       reconnect=False):
+  client = SignalingClient(base_url)
+  code = await client.generate_code()
+
+  track = SyntheticVideoTrack(width, height, fps)
+  started = time.perf_counter()
+  sender = await connect_sender(client, code, track, trickle)
+
+  data = await client.wait_for_offer(code, 5)
+  worker = WebRTCWorker(code=code, widget_win_id=0, offer=data["offer"], render="none", codecs=codecs)
+  probe = LatencyProbe()
+  if load_ms:
+    simulate_render_load(worker, load_ms)
+  connected = {}
+  # Direct: nothing runs a Qt event loop here to deliver a queued cross-thread signal
+  worker.connection_state_changed.connect(
+    lambda state: state == "connected" and connected.setdefault("at", time.perf_counter()),
+    Qt.DirectConnection,
+  )
+  loop = pool.acquire() if pool else None
+  worker.start(loop)
+
+  answer = None
+  while answer is None:
+    answer = await client.wait_for_answer(code, 5)
+  await sender.setRemoteDescription(RTCSessionDescription(**answer["answer"]))
+  # The worker builds its pipeline right after sending the answer, before any frame can arrive;
+  # if it never does, no frames reach the probe and the scenario reports that below
+  if await wait_until(lambda: worker.gst_pipeline.pipeline is not None, 10):
+    probe.attach(worker.gst_pipeline.pipeline.get_by_name("headless"))
+
+  result = {"resolution": f"{width}x{height}", "fps_target": fps, "trickle": trickle,
+            "codec": negotiated_codec(answer["answer"]["sdp"])}
+  if not await wait_until(lambda: probe.first_frame_at is not None, 30):
+    result["error"] = "no frames received"
+    worker.stop()
+    if pool:
+      pool.release(loop)
+    await sender.close()
+    await client.close()
+    return result
+
+  result["time_to_connected_ms"] = (connected.get("at", float("nan")) - started) * 1000
+  result["time_to_first_frame_ms"] = (probe.first_frame_at - started) * 1000
+
+  # Give the encoder a second to settle before measuring steady state
+  await asyncio.sleep(1)
+  probe.reset()
+  mailbox_before = worker.mailbox.stats()
+  sent_before = track.seq
+  cpu_before = time.process_time()
+  window_start = time.perf_counter()
+  await asyncio.sleep(duration)
+  elapsed = time.perf_counter() - window_start
+  cpu = time.process_time() - cpu_before
+  sent = track.seq - sent_before
+  mailbox_after = worker.mailbox.stats()
+
+  with probe.lock:
+    latencies = list(probe.latencies_ms)
+    delivered = len(probe.sequences)
+    undecodable = probe.undecodable
+
+  render_before = mailbox_before["consumers"].get("render", {"delivered": 0, "dropped": 0})
+  render_after = mailbox_after["consumers"]["render"]
+  result.update({
+    "latency_p50_ms": percentile(latencies, 50),
+    "latency_p90_ms": percentile(latencies, 90),
+    "latency_p99_ms": percentile(latencies, 99),
+    "fps_achieved": delivered / elapsed,
+    "drop_rate": max(0.0, 1 - delivered / sent) if sent else float("nan"),
+    "render_dropped": render_after["dropped"] - render_before["dropped"],
+    "undecodable_frames": undecodable,
+    # Sender encode and receiver decode share this process, so this is the cost of both ends
+    "cpu_ms_per_frame": cpu * 1000 / delivered if delivered else float("nan"),
+    "quality_changes": len(track.targets),
+    "final_resolution": f"{track.width}x{track.height}",
+    "final_fps": track.fps,
+  })
+  if reconnect:
+    sender, track, result["reconnect_ms"] = await measure_reconnect(client, code, sender, track, probe, trickle)
+
+  worker.stop()
+  if pool:
+    pool.release(loop)
+  await sender.close()
+  await client.close()
+  return result
+
+def print_results(results):
+  columns = [
+    ("resolution", "{}"), ("codec", "{}"), ("time_to_connected_ms", "{:.0f}"), ("time_to_first_frame_ms", "{:.0f}"),
+    ("latency_p50_ms", "{:.1f}"), ("latency_p90_ms", "{:.1f}"), ("latency_p99_ms", "{:.1f}"),
+    ("fps_achieved", "{:.1f}"), ("drop_rate", "{:.1%}"), ("cpu_ms_per_frame", "{:.2f}"),
+    ("final_resolution", "{}"), ("final_fps", "{}"),
+  ]
+  print("  ".join(name for name, _ in columns))
+  for result in results:
+    if "error" in result:
+      print(f"{result['resolution']}  {result['error']}")
+      continue
+    print("  ".join(fmt.format(result[name]) for name, fmt in columns)
+          + (f"  reconnect {result['reconnect_ms']:.0f} ms" if "reconnect_ms" in result else ""))
+
+async def main(args):
+  runner = web.AppRunner(SignalingServer().create_app())
+  await runner.setup()
+  site = web.TCPSite(runner, "127.0.0.1", args.port)
+  await site.start()
+  base_url = f"http://127.0.0.1:{args.port}"
+  # WebRTCWorker makes its own SignalingClient, which reads the endpoint from the environment
+  os.environ["PIXELSTREAMER_SIGNALING_URL"] = base_url
+
+  # Concurrent sessions share a loop pool the way the app's SessionManager does
+  pool = EventLoopPool(args.loop_pool_size) if args.sessions > 1 else None
+  results = []
+  try:
+    for resolution in args.resolutions:
+      width, height = (int(x) for x in re.fullmatch(r"(\d+)x(\d+)", resolution).groups())
+      print(f"[Benchmark] {args.sessions} x {resolution} @ {args.fps}fps for {args.duration}s")
+      results += await asyncio.gather(*(
+        run_scenario(base_url, width, height, args.fps, args.duration, args.trickle, pool, args.codecs,
+                     args.simulate_load_ms, args.reconnect)
+        for _ in range(args.sessions)
+      ))
+  finally:
+    if pool:
+      pool.stop()
+    await runner.cleanup()
+
+  print_results(results)
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(results, f, indent=2)
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Loopback streaming benchmark for the PixelStreamer desktop pipeline")
+  parser.add_argument("--resolutions", nargs="+", default=["640x360", "1280x720", "1920x1080"])
+  parser.add_argument("--fps", type=int, default=30)
+  parser.add_argument("--duration", type=float, default=10, help="Seconds of steady-state streaming to measure")
+  parser.add_argument("--trickle", action="store_true", help="Send the sender's candidates separately, like the PWA")
+  parser.add_argument("--codecs", nargs="+", metavar="CODEC", help="Video codecs for the receiver to prefer, e.g. H264")
+  parser.add_argument("--simulate-load-ms", type=float, default=0,
+                      help="Extra render time per 720p frame, to watch adaptive quality step the sender down")
+  parser.add_argument("--reconnect", action="store_true",
+                      help="Re-offer on the same code after measuring and report how long until frames flow again")
+  parser.add_argument("--sessions", type=int, default=1,
+                      help="Phones to stream concurrently per resolution; CPU per frame then covers all of them")
+  parser.add_argument("--loop-pool-size", type=int, help="Event loops shared by concurrent sessions")
+  parser.add_argument("--port", type=int, default=8765, help="Port for the local signaling server")
+  parser.add_argument("--json", help="Also write the results to this file")
+  return parser.parse_args()
+
+if __name__ == "__main__":
+  asyncio.run(main(parse_args()))
@@ -0,0 +1,66 @@
+import asyncio
+
+class MailboxClosed(Exception):
+  pass
+
+# Single-slot handoff between the receive task and the frame consumers. put()
+# always overwrites the previous frame, so a slow consumer skips ahead to the
+# newest frame instead of building up latency; skipped frames count as dropped.
+class LatestFrameMailbox:
+  def __init__(self):
+    self.frame = None
+    self.seq = 0
+    self.closed = False
+    self.waiter = None
+    self.consumers = {}
+
+  @property
+  def received(self):
+    return self.seq
+
+  def put(self, frame):
+    self.seq += 1
+    self.frame = frame
+    self._wake()
+
+  def close(self):
+    self.closed = True
+    self._wake()
+
+  def _wake(self):
+    if self.waiter and not self.waiter.done():
+      self.waiter.set_result(None)
+    self.waiter = None
+
+  async def get(self, after_seq=0):
+    while self.seq <= after_seq:
+      if self.closed:
+        raise MailboxClosed()
+      if self.waiter is None:
+        self.waiter = asyncio.get_running_loop().create_future()
+      await self.waiter
+    return self.seq, self.frame
+
+  def count(self, name, dropped=False):
+    # For a consumer fed outside subscribe(), so it still shows up in stats()
+    counters = self.consumers.setdefault(name, {"delivered": 0, "dropped": 0})
+    counters["dropped" if dropped else "delivered"] += 1
+
+  async def subscribe(self, name):
+    counters = self.consumers.setdefault(name, {"delivered": 0, "dropped": 0})
+    last_seq = self.seq
+    while True:
+      try:
+        seq, frame = await self.get(last_seq)
+      except MailboxClosed:
+        return
+      counters["dropped"] += seq - last_seq - 1
+      counters["delivered"] += 1
+      last_seq = seq
+      yield frame
+
+  def stats(self):
+    return {
+      "received": self.received,
+      "consumers": {name: dict(counters) for name, counters in self.consumers.items()},
+    }
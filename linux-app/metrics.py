@@ -0,0 +1,174 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in milliseconds; the last bucket catches everything slower
+BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Histogram:
+  def __init__(self, buckets=BUCKETS_MS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value_ms):
+    self.counts[bisect.bisect_left(self.buckets, value_ms)] += 1
+    self.count += 1
+    self.sum += value_ms
+    self.max = max(self.max, value_ms)
+
+  def percentile(self, pct):
+    # Upper bound of the bucket holding the pct-th observation; good enough for an overlay
+    if not self.count:
+      return 0.0
+    target = pct / 100 * self.count
+    seen = 0
+    for bound, count in zip(self.buckets + (self.max,), self.counts):
+      seen += count
+      if seen >= target:
+        return min(bound, self.max)
+    return self.max
+
+  def summary(self):
+    return {
+      "count": self.count,
+      "mean_ms": self.sum / self.count if self.count else 0.0,
+      "p50_ms": self.percentile(50),
+      "p99_ms": self.percentile(99),
+      "max_ms": self.max,
+    }
+
+# Per-stage timings for one streaming session. Stages are observed from the
+# receive loop, the render thread and the recorder pool, hence the lock.
+class PipelineMetrics:
+  def __init__(self, session=""):
+    self.session = session
+    self.lock = threading.Lock()
+    self.stages = {}
+    self.peer = {}
+    self.frames = {}
+    self.quality = {}
+
+  def observe(self, stage, value_ms):
+    with self.lock:
+      if stage not in self.stages:
+        self.stages[stage] = Histogram()
+      self.stages[stage].observe(value_ms)
+
+  @contextmanager
+  def time(self, stage):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(stage, (time.perf_counter() - start) * 1000)
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        "session": self.session,
+        "stages": {name: histogram.summary() for name, histogram in self.stages.items()},
+        "peer": dict(self.peer),
+        "frames": dict(self.frames),
+        "quality": dict(self.quality),
+      }
+
+  def prometheus(self):
+    labels = f'session="{self.session}"'
+    lines = []
+    with self.lock:
+      for name, histogram in self.stages.items():
+        stage_labels = f'{labels},stage="{name}"'
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+          cumulative += count
+          lines.append(f'pixelstreamer_stage_seconds_bucket{{{stage_labels},le="{bound / 1000}"}} {cumulative}')
+        lines.append(f'pixelstreamer_stage_seconds_bucket{{{stage_labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"pixelstreamer_stage_seconds_sum{{{stage_labels}}} {histogram.sum / 1000}")
+        lines.append(f"pixelstreamer_stage_seconds_count{{{stage_labels}}} {histogram.count}")
+      for name, value in self.peer.items():
+        if value is not None:
+          lines.append(f"pixelstreamer_peer_{name}{{{labels}}} {value}")
+      for name, value in self.frames.items():
+        lines.append(f"pixelstreamer_frames_{name}{{{labels}}} {value}")
+      for name, value in self.quality.items():
+        if value is not None:
+          lines.append(f"pixelstreamer_quality_{name}{{{labels}}} {value}")
+    return lines
+
+def timed(metrics, stage):
+  return metrics.time(stage) if metrics else nullcontext()
+
+# Bitrate, jitter and loss for the inbound video stream from RTCPeerConnection.getStats().
+# previous is the last result, used to turn byte counters into a bitrate. There's no RTT here:
+# it only comes from remote-inbound-rtp, which needs an RTP sender, and the desktop only receives.
+async def collect_peer_stats(pc, previous=None):
+  report = await pc.getStats()
+  stats = {"bytes_received": 0, "packets_received": 0, "packets_lost": 0, "jitter_ms": None}
+  for entry in report.values():
+    if entry.type == "transport":
+      stats["bytes_received"] += entry.bytesReceived
+    elif entry.type == "inbound-rtp" and entry.kind == "video":
+      stats["packets_received"] += entry.packetsReceived
+      stats["packets_lost"] += entry.packetsLost
+      # aiortc reports jitter in RTP timestamp units; video runs on a 90kHz clock
+      stats["jitter_ms"] = entry.jitter / 90
+
+  stats["sampled_at"] = time.monotonic()
+  stats["bitrate_kbps"] = None
+  if previous:
+    elapsed = stats["sampled_at"] - previous["sampled_at"]
+    if elapsed > 0:
+      stats["bitrate_kbps"] = (stats["bytes_received"] - previous["bytes_received"]) * 8 / elapsed / 1000
+  total = stats["packets_received"] + stats["packets_lost"]
+  stats["loss_rate"] = stats["packets_lost"] / total if total else 0.0
+  return stats
+
+# Local HTTP endpoint serving every registered session's metrics:
+# /metrics in Prometheus text format and /metrics.json as JSON
+class MetricsServer:
+  def __init__(self, host="127.0.0.1", port=9102):
+    self.host = host
+    self.port = port
+    self.sessions = {}
+    self.runner = None
+
+  def register(self, metrics: PipelineMetrics):
+    self.sessions[metrics.session] = metrics
+
+  def unregister(self, metrics: PipelineMetrics):
+    self.sessions.pop(metrics.session, None)
+
+  async def start(self):
+    app = web.Application()
+    app.router.add_get("/metrics", self.handle_prometheus)
+    app.router.add_get("/metrics.json", self.handle_json)
+    self.runner = web.AppRunner(app)
+    await self.runner.setup()
+    await web.TCPSite(self.runner, self.host, self.port).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+  async def stop(self):
+    if self.runner:
+      await self.runner.cleanup()
+      self.runner = None
+
+  async def handle_prometheus(self, request):
+    lines = ["# TYPE pixelstreamer_stage_seconds histogram"]
+    for metrics in list(self.sessions.values()):
+      lines += metrics.prometheus()
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+  async def handle_json(self, request):
+    return web.Response(
+      text=json.dumps([metrics.snapshot() for metrics in list(self.sessions.values())]),
+      content_type="application/json",
+    )
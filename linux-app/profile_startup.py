@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Cold-start profile for the desktop app. Runs app.py under `python -X importtime` with
+# --profile-startup a few times, then reports how long the window took to be ready, the
+# slowest imports, and whether any of the heavy streaming modules crept back into startup.
+#
+#   python3 profile_startup.py --runs 5 --top 15 --json startup.json
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# "import time:  self [us] | cumulative | imported package", nested imports indented by two spaces
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+READY_LINE = re.compile(r"startup: window ready after (\d+) ms")
+
+# Should only load once a code has been generated
+HEAVY_MODULES = ("aiortc", "av", "cv2", "numpy", "gi", "aiohttp")
+
+def run_app(app_args):
+  env = dict(os.environ)
+  # No display needed; the window still goes through a full layout and paint
+  env.setdefault("QT_QPA_PLATFORM", "offscreen")
+  started = time.perf_counter()
+  proc = subprocess.run(
+    [sys.executable, "-X", "importtime", "app.py", "--profile-startup", *app_args],
+    cwd=HERE, env=env, capture_output=True, text=True, timeout=120,
+  )
+  wall_ms = (time.perf_counter() - started) * 1000
+  ready = READY_LINE.search(proc.stdout)
+  if not ready:
+    raise RuntimeError(f"app.py exited with {proc.returncode} before its window was ready:\n{proc.stderr[-2000:]}")
+  return int(ready.group(1)), wall_ms, parse_imports(proc.stderr)
+
+def parse_imports(stderr):
+  imports = []
+  for line in stderr.splitlines():
+    match = IMPORT_LINE.match(line)
+    if match:
+      self_us, cumulative_us, indent, name = match.groups()
+      imports.append({
+        "module": name,
+        "depth": (len(indent) - 1) // 2,
+        "self_ms": int(self_us) / 1000,
+        "cumulative_ms": int(cumulative_us) / 1000,
+      })
+  return imports
+
+def main(args):
+  runs = [run_app(args.app_args) for _ in range(args.runs)]
+  ready_ms = [ready for ready, _, _ in runs]
+  wall_ms = [wall for _, wall, _ in runs]
+  # The last run has the warmest disk cache, so its import profile is the least noisy
+  imports = runs[-1][2]
+  top_level = sorted((i for i in imports if i["depth"] == 0), key=lambda i: i["cumulative_ms"], reverse=True)
+  loaded = {i["module"] for i in imports}
+  heavy = [name for name in HEAVY_MODULES if name in loaded]
+
+  print(f"window ready: median {statistics.median(ready_ms):.0f} ms, min {min(ready_ms)} ms over {len(runs)} runs")
+  print(f"process wall time (including interpreter start and exit): median {statistics.median(wall_ms):.0f} ms")
+  print(f"imports: {sum(i['cumulative_ms'] for i in top_level):.0f} ms in {len(imports)} modules")
+  print()
+  print(f"{'cumulative':>10}  {'self':>8}  module")
+  for entry in top_level[:args.top]:
+    print(f"{entry['cumulative_ms']:>8.1f}ms  {entry['self_ms']:>6.1f}ms  {entry['module']}")
+  if heavy:
+    print(f"\nheavy modules loaded at startup: {', '.join(heavy)}")
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump({
+        "window_ready_ms": ready_ms,
+        "wall_ms": wall_ms,
+        "heavy_modules_at_startup": heavy,
+        "imports": top_level[:args.top],
+      }, f, indent=2)
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Import-time and time-to-window profile for app.py")
+  parser.add_argument("--runs", type=int, default=3)
+  parser.add_argument("--top", type=int, default=20, help="How many of the slowest top-level imports to list")
+  parser.add_argument("--json", help="Also write the results to this file, e.g. to track cold start over time")
+  parser.add_argument("app_args", nargs="*", help="Extra arguments for app.py, after --")
+  return parser.parse_args()
+
+if __name__ == "__main__":
+  main(parse_args())
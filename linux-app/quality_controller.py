@@ -0,0 +1,111 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Steps the phone's encoder walks through. Resolution gives under CPU pressure on the
+# desktop (fewer pixels to decode and copy); frame rate gives under network pressure
+# (fewer packets in flight, each frame keeps its detail). None leaves the phone's own setting.
+RESOLUTION_STEPS = (1.0, 1.5, 2.0, 3.0)
+FRAMERATE_STEPS = (None, 30, 20, 15)
+
+# Share of frames the render consumer may skip, and the loss/jitter the link may show,
+# before a window counts as under pressure
+MAX_RENDER_DROP_RATE = 0.1
+MAX_LOSS_RATE = 0.03
+MAX_JITTER_MS = 40
+
+# Windows in a row a condition has to hold before stepping; down is quick, up is cautious
+DEGRADE_AFTER = 2
+RECOVER_AFTER = 5
+
+MIN_BITRATE_KBPS = 300
+
+# Watches one session's render and network stats and decides what the phone should send.
+# update() is fed once per metrics interval and returns a new target only when it changes.
+class QualityController:
+  def __init__(self, max_bitrate_kbps=None):
+    self.max_bitrate_kbps = max_bitrate_kbps
+    self.resolution_step = 0
+    self.framerate_step = 0
+    self.bitrate_kbps = max_bitrate_kbps
+    self.previous = None
+    self.cpu_windows = 0
+    self.network_windows = 0
+    self.healthy_windows = 0
+
+  def reset(self):
+    # Counters restart with a new peer connection; the current steps are kept
+    self.previous = None
+
+  def target(self):
+    return {
+      "scaleResolutionDownBy": RESOLUTION_STEPS[self.resolution_step],
+      "maxFramerate": FRAMERATE_STEPS[self.framerate_step],
+      "maxBitrateKbps": round(self.bitrate_kbps) if self.bitrate_kbps else None,
+    }
+
+  def window(self, peer, frames):
+    # Counters are cumulative, so each decision looks at the change since the last call
+    render = frames["consumers"].get("render", {"delivered": 0, "dropped": 0})
+    current = {
+      "render_delivered": render["delivered"],
+      "render_dropped": render["dropped"],
+      "packets_received": peer["packets_received"],
+      "packets_lost": peer["packets_lost"],
+    }
+    previous, self.previous = self.previous, current
+    if previous is None:
+      return None
+    delta = {name: current[name] - previous[name] for name in current}
+    rendered = delta["render_delivered"] + delta["render_dropped"]
+    packets = delta["packets_received"] + delta["packets_lost"]
+    return {
+      "render_drop_rate": delta["render_dropped"] / rendered if rendered else 0.0,
+      "loss_rate": max(0, delta["packets_lost"]) / packets if packets > 0 else 0.0,
+      "jitter_ms": peer.get("jitter_ms") or 0.0,
+      "bitrate_kbps": peer.get("bitrate_kbps"),
+    }
+
+  def update(self, peer, frames):
+    window = self.window(peer, frames)
+    if window is None:
+      return None
+    before = self.target()
+
+    cpu_pressure = window["render_drop_rate"] > MAX_RENDER_DROP_RATE
+    network_pressure = window["loss_rate"] > MAX_LOSS_RATE or window["jitter_ms"] > MAX_JITTER_MS
+    self.cpu_windows = self.cpu_windows + 1 if cpu_pressure else 0
+    self.network_windows = self.network_windows + 1 if network_pressure else 0
+    self.healthy_windows = 0 if cpu_pressure or network_pressure else self.healthy_windows + 1
+
+    if self.cpu_windows >= DEGRADE_AFTER and self.resolution_step < len(RESOLUTION_STEPS) - 1:
+      self.resolution_step += 1
+      self.cpu_windows = 0
+    if self.network_windows >= DEGRADE_AFTER:
+      if self.framerate_step < len(FRAMERATE_STEPS) - 1:
+        self.framerate_step += 1
+      # Cap just under what actually got through, so the sender's queue can drain
+      if window["bitrate_kbps"]:
+        self.bitrate_kbps = max(MIN_BITRATE_KBPS, window["bitrate_kbps"] * 0.85)
+      self.network_windows = 0
+    if self.healthy_windows >= RECOVER_AFTER:
+      # Undo one step at a time. The bitrate cap goes in one go: it's only a ceiling and
+      # the phone's congestion control still ramps up gradually underneath it
+      if self.framerate_step > 0:
+        self.framerate_step -= 1
+      elif self.bitrate_kbps != self.max_bitrate_kbps:
+        self.bitrate_kbps = self.max_bitrate_kbps
+      elif self.resolution_step > 0:
+        self.resolution_step -= 1
+      self.healthy_windows = 0
+
+    target = self.target()
+    if target == before:
+      return None
+    logger.info("Quality target %s (render drops %.0f%%, loss %.1f%%, jitter %.0f ms)", target,
+                window["render_drop_rate"] * 100, window["loss_rate"] * 100, window["jitter_ms"])
+    return target
+
+def quality_message(target):
+  return json.dumps({"type": "quality", **target})
@@ -0,0 +1,83 @@
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import cv2
+from av import VideoFrame
+from av.video.frame import PictureType
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+DROP_POLICIES = ("drop-oldest", "keyframe-only", "every-nth")
+
+# Writes received frames as JPEGs off the asyncio thread. Frames wait in a bounded
+# queue; when the writers fall behind the oldest pending frame is discarded, so
+# submit() never blocks the receive loop.
+class FrameRecorder:
+  def __init__(self, directory="imgs", policy="drop-oldest", max_pending=8, every_nth=5, workers=2, timestamp=True):
+    if policy not in DROP_POLICIES:
+      raise ValueError(f"Unknown drop policy: {policy}")
+    self.directory = directory
+    self.policy = policy
+    self.every_nth = max(1, every_nth)
+    self.timestamp = timestamp
+    self.pending = deque(maxlen=max_pending)
+    self.lock = threading.Lock()
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="recorder")
+    self.frame_count = 0
+    self.written = 0
+    self.dropped = 0
+    self.skipped = 0
+    self.running = True
+    self.metrics = None
+    os.makedirs(directory, exist_ok=True)
+
+  def accepts(self, frame: VideoFrame):
+    if not isinstance(frame, VideoFrame):
+      # Still-encoded H.264 when GStreamer does the decoding; there are no pixels to save
+      return False
+    if self.policy == "keyframe-only":
+      # pict_type is set from the encoded frame by video_codecs.enable_keyframe_tagging()
+      return frame.key_frame or frame.pict_type == PictureType.I
+    if self.policy == "every-nth":
+      return self.frame_count % self.every_nth == 0
+    return True
+
+  def submit(self, frame: VideoFrame):
+    if not self.running:
+      return
+    self.frame_count += 1
+    if not self.accepts(frame):
+      self.skipped += 1
+      return
+
+    with self.lock:
+      if len(self.pending) == self.pending.maxlen:
+        self.dropped += 1
+      self.pending.append((self.frame_count, datetime.now(), frame))
+    self.executor.submit(self._write_next)
+
+  def _write_next(self):
+    with self.lock:
+      if not self.pending:
+        return
+      index, received_at, frame = self.pending.popleft()
+
+    try:
+      with timed(self.metrics, "record"):
+        img = frame.to_ndarray(format="bgr24")
+        if self.timestamp:
+          stamp = received_at.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+          cv2.putText(img, stamp, (10, img.shape[0] - 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
+        cv2.imwrite(os.path.join(self.directory, f"received_frame_{index}.jpg"), img)
+      self.written += 1
+    except Exception as e:
+      logger.error("Failed to write frame %d: %s", index, e)
+
+  def stop(self, wait=True):
+    self.running = False
+    self.executor.shutdown(wait=wait)
+    logger.info("Wrote %d frames, dropped %d, skipped %d", self.written, self.dropped, self.skipped)
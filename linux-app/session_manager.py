@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+from PyQt5.QtCore import QObject, pyqtSignal
+from webrtc_pipeline import WebRTCWorker
+
+logger = logging.getLogger(__name__)
+
+def default_pool_size():
+  # aiortc decodes on its own threads and GStreamer renders on its own, so the
+  # loops only do signaling and frame hand-off; one per two cores is plenty
+  return max(1, min(4, (os.cpu_count() or 2) // 2))
+
+def numbered_device(base, index):
+  # /dev/video10 -> /dev/video11 for the second session, and so on
+  if not base or index == 0:
+    return base
+  match = re.match(r"(.*?)(\d+)$", base)
+  if not match:
+    return f"{base}{index}"
+  return f"{match.group(1)}{int(match.group(2)) + index}"
+
+# A fixed set of event loops, each on its own thread. Sessions go to the least loaded loop.
+class EventLoopPool:
+  def __init__(self, size=None):
+    self.loops = []
+    self.load = {}
+    for i in range(size or default_pool_size()):
+      loop = asyncio.new_event_loop()
+      threading.Thread(target=loop.run_forever, daemon=True, name=f"webrtc-loop-{i}").start()
+      self.loops.append(loop)
+      self.load[loop] = 0
+
+  def acquire(self):
+    loop = min(self.loops, key=self.load.get)
+    self.load[loop] += 1
+    return loop
+
+  def release(self, loop):
+    self.load[loop] -= 1
+
+  def stop(self):
+    for loop in self.loops:
+      loop.call_soon_threadsafe(loop.stop)
+
+class Session:
+  def __init__(self, code, index, worker, loop):
+    self.code = code
+    self.index = index
+    self.worker = worker
+    self.loop = loop
+
+# Runs one WebRTCWorker per paired phone on a shared pool of event loops instead of
+# a thread and loop per connection. Each session keeps its own pipeline and outputs;
+# index numbers the per-session devices (preview tile, virtual camera, microphone).
+class SessionManager(QObject):
+  session_state_changed = pyqtSignal(str, str)
+  session_metrics_updated = pyqtSignal(str, dict)
+
+  def __init__(self, pool_size=None):
+    super().__init__()
+    self.pool = EventLoopPool(pool_size)
+    self.sessions = {}
+
+  def free_index(self):
+    used = {session.index for session in self.sessions.values()}
+    index = 0
+    while index in used:
+      index += 1
+    return index
+
+  def start_session(self, code, offer, widget_win_id, index=None, **worker_options):
+    if code in self.sessions:
+      self.stop_session(code)
+    index = self.free_index() if index is None else index
+    worker = WebRTCWorker(code=code, widget_win_id=widget_win_id, offer=offer, **worker_options)
+    worker.connection_state_changed.connect(lambda state: self.session_state_changed.emit(code, state))
+    worker.metrics_updated.connect(lambda snapshot: self.session_metrics_updated.emit(code, snapshot))
+
+    loop = self.pool.acquire()
+    self.sessions[code] = Session(code, index, worker, loop)
+    worker.start(loop)
+    logger.info("Started session %s (#%d) on loop %d of %d", code, index, self.pool.loops.index(loop), len(self.pool.loops))
+    return worker
+
+  def stop_session(self, code):
+    session = self.sessions.pop(code, None)
+    if session is None:
+      return
+    session.worker.stop()
+    self.pool.release(session.loop)
+
+  def workers(self):
+    return [session.worker for session in self.sessions.values()]
+
+  def stop(self, timeout=3.0):
+    sessions = list(self.sessions.values())
+    for code in list(self.sessions):
+      self.stop_session(code)
+    # Each _run still has to close its peer connection and signaling client on its loop
+    for session in sessions:
+      session.worker.wait_closed(timeout)
+    self.pool.stop()
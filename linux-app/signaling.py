@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import aiohttp
+from PyQt5.QtCore import QObject, pyqtSignal
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = {
+  "generateCode": "https://generatecode-qaf2yvcrrq-uc.a.run.app",
+  "deleteCode": "https://deletecode-qaf2yvcrrq-uc.a.run.app",
+  "checkOffer": "https://checkoffer-qaf2yvcrrq-uc.a.run.app",
+  "waitForOffer": "https://waitforoffer-qaf2yvcrrq-uc.a.run.app",
+  "submitOffer": "https://submitoffer-qaf2yvcrrq-uc.a.run.app",
+  "updateOffer": "https://updateoffer-qaf2yvcrrq-uc.a.run.app",
+  "submitAnswer": "https://submitanswer-qaf2yvcrrq-uc.a.run.app",
+  "waitForAnswer": "https://waitforanswer-qaf2yvcrrq-uc.a.run.app",
+  "addCandidates": "https://addcandidates-qaf2yvcrrq-uc.a.run.app",
+  "waitForCandidates": "https://waitforcandidates-qaf2yvcrrq-uc.a.run.app",
+}
+
+# Set PIXELSTREAMER_SIGNALING_URL (e.g. http://127.0.0.1:8080) to send every call to <url>/<function name>
+def endpoint_url(name, base_url=None):
+  base_url = base_url or os.environ.get("PIXELSTREAMER_SIGNALING_URL")
+  if base_url:
+    return f"{base_url.rstrip('/')}/{name}"
+  return ENDPOINTS[name]
+
+class SignalingError(Exception):
+  def __init__(self, message, status=None, malformed=False):
+    super().__init__(message)
+    self.status = status
+    # The body wasn't JSON, e.g. a proxy or Cloud Run error page rather than one of our functions
+    self.malformed = malformed
+
+  @property
+  def endpoint_missing(self):
+    return self.malformed or self.status in (404, 405)
+
+# Cap on the pause between long-polls after a transient failure
+LONG_POLL_RETRY_MAX_DELAY = 5.0
+
+# Async client for the signaling Cloud Functions. One keep-alive session is shared
+# by every call, so polling reuses the TLS connection instead of handshaking each time.
+class SignalingClient:
+  def __init__(self, base_url=None, timeout=5.0, retries=3, backoff=0.25, max_backoff=2.0):
+    self.base_url = base_url
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.session = None
+
+  def get_session(self):
+    if self.session is None or self.session.closed:
+      connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=60, ttl_dns_cache=300)
+      self.session = aiohttp.ClientSession(connector=connector)
+    return self.session
+
+  async def post(self, name, payload=None, timeout=None, retries=None):
+    retries = self.retries if retries is None else retries
+    url = endpoint_url(name, self.base_url)
+    client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+    attempt = 0
+    while True:
+      try:
+        async with self.get_session().post(url, json=payload or {}, timeout=client_timeout) as res:
+          # Server errors are worth retrying, anything else is the caller's answer
+          if res.status < 500:
+            try:
+              data = await res.json(content_type=None) if res.status != 204 else None
+            except ValueError as e:
+              # e.g. Cloud Run's HTML 404 for a function that isn't deployed
+              raise SignalingError(f"{name} returned {res.status} without a JSON body", res.status, malformed=True) from e
+            return res.status, data
+          error = SignalingError(f"{name} returned {res.status}", res.status)
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        error = SignalingError(f"{name} failed: {e!r}")
+
+      if attempt >= retries:
+        raise error
+      delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+      attempt += 1
+      await asyncio.sleep(delay)
+
+  async def generate_code(self):
+    status, data = await self.post("generateCode")
+    if status != 200:
+      raise SignalingError(f"generateCode returned {status}", status)
+    return data["code"]
+
+  async def check_offer(self, code):
+    status, data = await self.post("checkOffer", {"code": code})
+    if status == 204:
+      return None
+    if status != 200:
+      raise SignalingError(f"checkOffer returned {status}", status)
+    return data
+
+  async def wait_for_offer(self, code, timeout=25, since=None):
+    # Long-poll: the server holds the request until the offer lands or its timeout passes (204).
+    # With since, only an offer with a newer revision (a re-offer) ends the wait.
+    payload = {"code": code, "timeout": timeout}
+    if since is not None:
+      payload["since"] = since
+    status, data = await self.post("waitForOffer", payload, timeout=timeout + 10, retries=0)
+    if status == 204:
+      return None
+    if status != 200:
+      raise SignalingError(f"waitForOffer returned {status}", status)
+    return data
+
+  async def submit_offer(self, code, offer, metadata=None):
+    status, _ = await self.post("submitOffer", {"code": code, "offer": offer, "metadata": metadata})
+    if status != 200:
+      raise SignalingError(f"submitOffer returned {status}", status)
+
+  async def update_offer(self, code, offer, candidates=None, metadata=None):
+    status, data = await self.post("updateOffer", {"code": code, "offer": offer, "candidates": candidates or [],
+                                                   "metadata": metadata})
+    if status != 200:
+      raise SignalingError(f"updateOffer returned {status}", status)
+    return data.get("revision")
+
+  async def wait_for_answer(self, code, timeout=25):
+    status, data = await self.post("waitForAnswer", {"code": code, "timeout": timeout}, timeout=timeout + 10, retries=0)
+    if status == 204:
+      return None
+    if status != 200:
+      raise SignalingError(f"waitForAnswer returned {status}", status)
+    return data
+
+  async def submit_answer(self, code, answer):
+    status, _ = await self.post("submitAnswer", {"code": code, "answer": answer}, timeout=10)
+    if status != 200:
+      raise SignalingError(f"submitAnswer returned {status}", status)
+
+  async def add_candidates(self, code, candidates, complete=False):
+    status, _ = await self.post("addCandidates", {"code": code, "candidates": candidates, "complete": complete})
+    if status != 200:
+      raise SignalingError(f"addCandidates returned {status}", status)
+
+  async def wait_for_candidates(self, code, since=0, timeout=25):
+    # Returns (new candidates after index `since`, complete); ([], False) when the long-poll times out
+    status, data = await self.post("waitForCandidates", {"code": code, "since": since, "timeout": timeout},
+                                   timeout=timeout + 10, retries=1)
+    if status == 204:
+      return [], False
+    if status != 200:
+      raise SignalingError(f"waitForCandidates returned {status}", status)
+    return data["candidates"], data["complete"]
+
+  async def delete_code(self, code):
+    status, _ = await self.post("deleteCode", {"code": code}, retries=1)
+    return status == 200
+
+  async def close(self):
+    if self.session and not self.session.closed:
+      await self.session.close()
+
+# Runs a SignalingClient on a background event loop so nothing blocks the Qt GUI
+# thread; results are delivered as signals, which Qt queues onto the GUI thread.
+class QtSignalingBridge(QObject):
+  code_generated = pyqtSignal(str)
+  code_failed = pyqtSignal(str)
+  offer_received = pyqtSignal(str, dict)
+  offer_timed_out = pyqtSignal(str)
+
+  def __init__(self, base_url=None, max_attempts=30, base_delay=1.0, max_delay=30.0, long_poll=True, long_poll_seconds=25):
+    super().__init__()
+    self.client = SignalingClient(base_url)
+    self.long_poll = long_poll
+    self.long_poll_seconds = long_poll_seconds
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.poll_future = None
+    self.polling_code = None
+    self.loop = asyncio.new_event_loop()
+    threading.Thread(target=self.loop.run_forever, daemon=True, name="signaling").start()
+
+  def submit(self, coro):
+    return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+  def request_code(self):
+    self.submit(self._request_code())
+
+  async def _request_code(self):
+    try:
+      self.code_generated.emit(await self.client.generate_code())
+    except Exception as e:
+      logger.error("Failed to generate code: %s", e)
+      self.code_failed.emit(str(e))
+
+  def poll_for_offer(self, code):
+    self.cancel_polling()
+    self.polling_code = code
+    self.poll_future = self.submit(self._poll_for_offer(code))
+
+  def cancel_polling(self):
+    if self.poll_future:
+      self.poll_future.cancel()
+      self.poll_future = None
+    self.polling_code = None
+
+  async def _poll_for_offer(self, code):
+    if self.long_poll and await self._wait_for_offer(code):
+      return
+    await self._check_for_offer(code)
+
+  async def _wait_for_offer(self, code):
+    # Returns True once the offer has been delivered; False means fall back to polling checkOffer
+    total_wait = self.max_attempts * self.long_poll_seconds
+    failures = 0
+    for _ in range(self.max_attempts):
+      try:
+        data = await self.client.wait_for_offer(code, self.long_poll_seconds)
+      except SignalingError as e:
+        if e.endpoint_missing:
+          logger.warning("Long-poll unavailable (%s), falling back to polling", e)
+          return False
+        # A 5xx or a dropped connection: the next long-poll is still the fast path
+        failures += 1
+        delay = random.uniform(0, min(LONG_POLL_RETRY_MAX_DELAY, self.base_delay * (2 ** failures)))
+        logger.warning("Long-poll failed (%s), retrying in %.2f seconds", e, delay)
+        await asyncio.sleep(delay)
+        continue
+      failures = 0
+      if data:
+        logger.info("✅ Offer received!")
+        self.offer_received.emit(code, data["offer"])
+        return True
+      logger.debug("🕐 Not ready yet...")
+
+    logger.warning("⛔ Gave up waiting for offer after %ds.", total_wait)
+    self.offer_timed_out.emit(code)
+    return True
+
+  async def _check_for_offer(self, code):
+    for attempt in range(self.max_attempts):
+      logger.debug("[Polling] Attempt %d", attempt + 1)
+      try:
+        data = await self.client.check_offer(code)
+        if data:
+          logger.info("✅ Offer received!")
+          self.offer_received.emit(code, data["offer"])
+          return
+        logger.debug("🕐 Not ready yet...")
+      except SignalingError as e:
+        logger.warning("❌ Poll error: %s", e)
+
+      delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt + 1))))
+      logger.debug("🔁 Retrying in %.2f seconds...", delay)
+      await asyncio.sleep(delay)
+
+    logger.warning("⛔ Gave up waiting for offer.")
+    self.offer_timed_out.emit(code)
+
+  def delete_code(self, code, wait=False):
+    # Ending one phone's session mustn't stop the wait for the next phone's offer on another code
+    if code == self.polling_code:
+      self.cancel_polling()
+    future = self.submit(self.client.delete_code(code))
+    if wait:
+      try:
+        future.result(timeout=3)
+      except Exception as e:
+        logger.error("Failed to delete code: %s", e)
+
+  def close(self):
+    self.cancel_polling()
+    try:
+      self.submit(self.client.close()).result(timeout=2)
+    except Exception:
+      pass
+    self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Local, in-memory stand-in for the Firebase signaling functions. Serves every
+# function at /<functionName> with the same request/response shapes, including the
+# waitFor* long-polls. Point the desktop app at it with
+# PIXELSTREAMER_SIGNALING_URL=http://127.0.0.1:8080
+import argparse
+import asyncio
+import random
+import string
+from aiohttp import web
+
+CHARSET = string.ascii_uppercase + string.digits
+LONG_POLL_DEFAULT_SECONDS = 25
+LONG_POLL_MAX_SECONDS = 50
+
+CORS_HEADERS = {
+  "Access-Control-Allow-Origin": "*",
+  "Access-Control-Allow-Methods": "POST, OPTIONS",
+  "Access-Control-Allow-Headers": "Content-Type",
+}
+
+def error(status, message):
+  return web.json_response({"error": message}, status=status)
+
+def long_poll_seconds(timeout):
+  try:
+    seconds = float(timeout)
+  except (TypeError, ValueError):
+    return LONG_POLL_DEFAULT_SECONDS
+  if seconds <= 0:
+    return LONG_POLL_DEFAULT_SECONDS
+  return min(seconds, LONG_POLL_MAX_SECONDS)
+
+class SignalingServer:
+  def __init__(self):
+    self.codes = {}
+    self.changed = asyncio.Condition()
+
+  def create_app(self):
+    app = web.Application(middlewares=[self.cors_middleware])
+    for name in ("generateCode", "deleteCode", "validateCode", "submitOffer", "checkOffer",
+                 "waitForOffer", "submitAnswer", "checkAnswer", "waitForAnswer", "updateOffer",
+                 "addCandidates", "waitForCandidates"):
+      app.router.add_route("*", f"/{name}", getattr(self, name))
+    return app
+
+  @web.middleware
+  async def cors_middleware(self, request, handler):
+    if request.method == "OPTIONS":
+      return web.Response(status=204, headers=CORS_HEADERS)
+    if request.method != "POST":
+      return error(405, "Method Not Allowed")
+    response = await handler(request)
+    response.headers.update(CORS_HEADERS)
+    return response
+
+  async def read(self, request):
+    try:
+      body = await request.json()
+    except Exception:
+      body = {}
+    code = (body.get("code") or "").strip().upper()
+    return body, code
+
+  async def update(self, code, **fields):
+    async with self.changed:
+      self.codes[code].update(fields)
+      self.changed.notify_all()
+
+  async def wait_for(self, code, ready, seconds):
+    async def reached():
+      async with self.changed:
+        await self.changed.wait_for(lambda: code not in self.codes or ready(self.codes[code]))
+    try:
+      await asyncio.wait_for(reached(), seconds)
+    except asyncio.TimeoutError:
+      pass
+    return self.codes.get(code)
+
+  async def wait_for_status(self, code, status, seconds):
+    return await self.wait_for(code, lambda doc: doc["status"] == status, seconds)
+
+  async def generateCode(self, request):
+    code = "".join(random.choices(CHARSET, k=5))
+    while code in self.codes:
+      code = "".join(random.choices(CHARSET, k=5))
+    self.codes[code] = {"status": "waiting"}
+    return web.json_response({"code": code})
+
+  async def deleteCode(self, request):
+    _, code = await self.read(request)
+    if len(code) != 5:
+      return error(400, "Invalid code format")
+    async with self.changed:
+      self.codes.pop(code, None)
+      self.changed.notify_all()
+    return web.json_response({"message": f"Code {code} deleted."})
+
+  async def validateCode(self, request):
+    _, code = await self.read(request)
+    if len(code) != 5:
+      return error(400, "Invalid code format")
+    doc = self.codes.get(code)
+    if doc is None:
+      return web.json_response({"success": False, "valid": False, "message": "Code not found"}, status=404)
+    if doc["status"] != "waiting":
+      return web.json_response({"success": True, "valid": False, "message": "Code already used"}, status=409)
+    return web.json_response({"success": True, "valid": True, "message": "Code is valid"})
+
+  async def submitOffer(self, request):
+    body, code = await self.read(request)
+    doc = self.codes.get(code)
+    if not isinstance(body.get("offer"), dict):
+      return error(400, "Missing or invalid SDP offer")
+    if doc is None:
+      return error(404, "Code not found")
+    if doc["status"] != "waiting":
+      return error(409, "Code already used or invalid")
+    await self.update(code, offer=body["offer"], metadata=body.get("metadata"), status="offered")
+    return web.json_response({"success": True, "message": "Offer and ICE candidates saved"})
+
+  def offer_response(self, doc):
+    return web.json_response({
+      "offer": doc["offer"],
+      "candidates": doc.get("candidates"),
+      "metadata": doc.get("metadata"),
+      "revision": doc.get("revision", 0),
+    })
+
+  async def checkOffer(self, request):
+    _, code = await self.read(request)
+    doc = self.codes.get(code)
+    if doc is None:
+      return error(404, "Code not found")
+    if doc["status"] != "offered":
+      return web.Response(status=204)
+    return self.offer_response(doc)
+
+  async def waitForOffer(self, request):
+    body, code = await self.read(request)
+    since = body.get("since")
+    since = since if isinstance(since, int) else -1
+    if code not in self.codes:
+      return error(404, "Code not found")
+
+    def ready(doc):
+      return doc["status"] == "offered" and doc.get("revision", 0) > since
+
+    doc = await self.wait_for(code, ready, long_poll_seconds(body.get("timeout")))
+    if doc is None:
+      return error(404, "Code not found")
+    # Same as the Cloud Function: a timed-out wait is a 204, even if an older revision is on file
+    if not ready(doc):
+      return web.Response(status=204)
+    return self.offer_response(doc)
+
+  async def submitAnswer(self, request):
+    body, code = await self.read(request)
+    if not code or not body.get("answer"):
+      return error(400, "Missing required fields")
+    if code not in self.codes:
+      return error(404, "Code not found")
+    await self.update(code, answer=body["answer"], answerCandidates=body.get("candidates") or [], status="answered")
+    return web.json_response({"success": True})
+
+  def answer_response(self, doc):
+    return web.json_response({"answer": doc["answer"], "candidates": doc.get("answerCandidates", [])})
+
+  async def checkAnswer(self, request):
+    _, code = await self.read(request)
+    doc = self.codes.get(code)
+    if doc is None:
+      return error(404, "Code not found")
+    if doc["status"] != "answered":
+      return web.Response(status=204)
+    return self.answer_response(doc)
+
+  async def waitForAnswer(self, request):
+    body, code = await self.read(request)
+    if code not in self.codes:
+      return error(404, "Code not found")
+    doc = await self.wait_for_status(code, "answered", long_poll_seconds(body.get("timeout")))
+    if doc is None:
+      return error(404, "Code not found")
+    if doc["status"] != "answered":
+      return web.Response(status=204)
+    return self.answer_response(doc)
+
+  async def updateOffer(self, request):
+    body, code = await self.read(request)
+    if not isinstance(body.get("offer"), dict):
+      return error(400, "Missing or invalid SDP offer")
+    if not isinstance(body.get("candidates"), list):
+      return error(400, "Missing or invalid ICE candidates")
+    doc = self.codes.get(code)
+    if doc is None:
+      return error(404, "Code not found")
+    if doc["status"] == "waiting":
+      return error(409, "No offer to update, use submitOffer")
+    revision = doc.get("revision", 0) + 1
+    doc.pop("answer", None)
+    doc.pop("answerCandidates", None)
+    await self.update(code, offer=body["offer"], candidates=body["candidates"], candidatesComplete=False,
+                      metadata=body.get("metadata"), status="offered", revision=revision)
+    return web.json_response({"success": True, "message": "Offer updated successfully", "revision": revision})
+
+  async def addCandidates(self, request):
+    body, code = await self.read(request)
+    candidates = body.get("candidates")
+    if len(code) != 5:
+      return error(400, "Invalid code format")
+    if not isinstance(candidates, list):
+      return error(400, "Missing or invalid ICE candidates")
+    if code not in self.codes:
+      return error(404, "Code not found")
+    async with self.changed:
+      doc = self.codes[code]
+      known = doc.setdefault("candidates", [])
+      known.extend(c for c in candidates if c not in known)
+      if body.get("complete"):
+        doc["candidatesComplete"] = True
+      self.changed.notify_all()
+    return web.json_response({"success": True, "message": "ICE candidates added"})
+
+  async def waitForCandidates(self, request):
+    body, code = await self.read(request)
+    since = body.get("since")
+    since = since if isinstance(since, int) and since > 0 else 0
+    if code not in self.codes:
+      return error(404, "Code not found")
+    doc = await self.wait_for(
+      code,
+      lambda doc: len(doc.get("candidates") or []) > since or doc.get("candidatesComplete", False),
+      long_poll_seconds(body.get("timeout")),
+    )
+    if doc is None:
+      return error(404, "Code not found")
+    candidates = (doc.get("candidates") or [])[since:]
+    complete = doc.get("candidatesComplete", False)
+    if not candidates and not complete:
+      return web.Response(status=204)
+    return web.json_response({"candidates": candidates, "complete": complete})
+
+def main():
+  parser = argparse.ArgumentParser(description="Local PixelStreamer signaling server")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  args = parser.parse_args()
+  web.run_app(SignalingServer().create_app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+  main()
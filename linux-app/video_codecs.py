@@ -0,0 +1,105 @@
+import logging
+from fractions import Fraction
+from aiortc import RTCRtpReceiver
+from aiortc import rtcrtpreceiver
+from aiortc.sdp import SessionDescription
+from av.video.frame import PictureType
+
+logger = logging.getLogger(__name__)
+
+VIDEO_TIME_BASE = Fraction(1, 90000)
+
+# Orders what the answer offers back to the phone. Codecs that aren't listed stay
+# available after the preferred ones, so a phone without them can still connect.
+def codec_preferences(names, kind="video"):
+  capabilities = RTCRtpReceiver.getCapabilities(kind).codecs
+  preferred = []
+  for name in names:
+    matches = [codec for codec in capabilities if codec.mimeType.lower() == f"{kind}/{name}".lower()]
+    if not matches:
+      logger.warning("Unknown %s codec %r, supported: %s", kind, name,
+                     sorted({codec.mimeType.split("/")[1] for codec in capabilities}))
+    preferred += [codec for codec in matches if codec not in preferred]
+  # rtx stays last: aiortc pairs it back up with whichever codec is chosen
+  preferred += [codec for codec in capabilities if codec not in preferred and not is_rtx(codec)]
+  preferred += [codec for codec in capabilities if is_rtx(codec)]
+  return preferred
+
+def is_rtx(codec):
+  return codec.mimeType.lower().endswith("/rtx")
+
+def negotiated_codec(sdp, kind="video"):
+  # The first codec in the answer's m-line is the one the phone will send
+  for media in SessionDescription.parse(sdp).media:
+    if media.kind == kind and media.rtp.codecs:
+      return media.rtp.codecs[0].mimeType.split("/")[1].upper()
+  return None
+
+# An H.264 access unit as it came off the jitter buffer: Annex B byte stream, not decoded yet
+class EncodedVideoFrame:
+  def __init__(self, data: bytes, pts: int):
+    self.data = data
+    self.pts = pts
+    self.time_base = VIDEO_TIME_BASE
+
+class H264PassthroughDecoder:
+  def decode(self, encoded_frame):
+    return [EncodedVideoFrame(encoded_frame.data, encoded_frame.timestamp)]
+
+def is_vp8_keyframe(data):
+  # Bit 0 of the VP8 frame tag is the inverse key frame flag
+  return bool(data) and not data[0] & 0x01
+
+def is_h264_keyframe(data):
+  # Annex B from aiortc's depayloader; an IDR slice (NAL type 5) starts a new reference chain
+  return any(nal and nal[0] & 0x1F == 5 for nal in data.split(b"\x00\x00\x01")[1:])
+
+KEYFRAME_DETECTORS = {
+  "video/vp8": is_vp8_keyframe,
+  "video/h264": is_h264_keyframe,
+}
+
+# Decoders don't reliably mark key frames (aiortc's VP8 decoder never does), so this
+# reads the encoded frame instead and marks what comes out as an I picture
+class KeyframeTaggingDecoder:
+  def __init__(self, decoder, is_keyframe):
+    self.decoder = decoder
+    self.is_keyframe = is_keyframe
+
+  def decode(self, encoded_frame):
+    frames = self.decoder.decode(encoded_frame)
+    if self.is_keyframe(encoded_frame.data):
+      for frame in frames:
+        frame.pict_type = PictureType.I
+    return frames
+
+# Switches read by the decoder hook; they apply to every track in the process from then on
+decoder_options = {"h264_passthrough": False, "tag_keyframes": False}
+
+def install_decoder_hook():
+  # aiortc decodes inside RTCRtpReceiver with no hook to opt out, so swap the decoder it looks up
+  if getattr(rtcrtpreceiver.get_decoder, "hooked", False):
+    return
+  software_decoder = rtcrtpreceiver.get_decoder
+
+  def get_decoder(codec):
+    mime_type = codec.mimeType.lower()
+    if mime_type == "video/h264" and decoder_options["h264_passthrough"]:
+      return H264PassthroughDecoder()
+    decoder = software_decoder(codec)
+    if decoder_options["tag_keyframes"] and mime_type in KEYFRAME_DETECTORS:
+      return KeyframeTaggingDecoder(decoder, KEYFRAME_DETECTORS[mime_type])
+    return decoder
+
+  get_decoder.hooked = True
+  rtcrtpreceiver.get_decoder = get_decoder
+
+def enable_h264_passthrough():
+  if not decoder_options["h264_passthrough"]:
+    decoder_options["h264_passthrough"] = True
+    install_decoder_hook()
+    logger.info("H.264 frames will be decoded by GStreamer")
+
+def enable_keyframe_tagging():
+  decoder_options["tag_keyframes"] = True
+  install_decoder_hook()
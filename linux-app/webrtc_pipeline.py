@@ -1,166 +1,900 @@
 import asyncio
+import functools
 import json
+import logging
+import os
 import threading
-import requests
+import time
 from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
+from aiortc.codecs.h264 import H264Decoder
+from aiortc.jitterbuffer import JitterFrame
+from aiortc.sdp import candidate_from_sdp
 from PyQt5.QtCore import QObject, pyqtSignal
 from av import VideoFrame
 import gi
-import cv2
 import numpy as np
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from recorder import FrameRecorder
+from frame_mailbox import LatestFrameMailbox
+from signaling import SignalingClient, SignalingError
+from metrics import PipelineMetrics, MetricsServer, collect_peer_stats, timed
+from audio_pipeline import AudioPipeline
+from quality_controller import QualityController, quality_message
+from video_codecs import (
+  EncodedVideoFrame, codec_preferences, enable_h264_passthrough, enable_keyframe_tagging, is_h264_keyframe,
+  negotiated_codec,
+)
 
 gi.require_version("Gst", "1.0")
-from gi.repository import Gst
+gi.require_version("GstVideo", "1.0")
+from gi.repository import Gst, GstVideo
 
 Gst.init(None)
 
+logger = logging.getLogger(__name__)
+
+FRAMERATE = "30/1"
+
+# Decoded av pixel formats that appsrc can take as-is, without a CPU colorspace conversion
+NATIVE_FORMATS = {
+  "yuv420p": "I420",
+  "yuvj420p": "I420",
+  "nv12": "NV12",
+  "rgb24": "RGB",
+  "bgr24": "BGR",
+}
+
+# Recycles fixed-size GstBuffers for one set of raw video caps; buffers return
+# to the pool once the sink releases them, so steady-state streaming doesn't allocate.
+# Unbounded by default: the branch queues (30 deep for recording) can hold more buffers
+# than a fixed pool has, and acquire_buffer would then block the preview on the encoder.
+class FrameBufferPool:
+  def __init__(self, caps, min_buffers=4, max_buffers=0):
+    self.caps = caps
+    self.info = GstVideo.VideoInfo.new_from_caps(caps)
+    self.pool = Gst.BufferPool.new()
+    config = self.pool.get_config()
+    Gst.BufferPool.config_set_params(config, caps, self.info.size, min_buffers, max_buffers)
+    self.pool.set_config(config)
+    self.pool.set_active(True)
+
+  def fill(self, frame: VideoFrame):
+    ret, buf = self.pool.acquire_buffer(None)
+    if ret != Gst.FlowReturn.OK:
+      return None
+
+    ok, mapinfo = buf.map(Gst.MapFlags.WRITE)
+    if not ok:
+      # Hand it back, or the pool runs dry and acquire_buffer blocks for good
+      self.pool.release_buffer(buf)
+      return None
+    try:
+      # Copy each plane straight from the decoder's memory, honouring both line strides
+      for i, plane in enumerate(frame.planes):
+        stride = self.info.stride[i]
+        src = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+        dst = np.ndarray((plane.height, stride), np.uint8, buffer=mapinfo.data, offset=self.info.offset[i])
+        if plane.line_size == stride:
+          dst[:] = src
+        else:
+          row_bytes = min(stride, plane.line_size)
+          dst[:, :row_bytes] = src[:, :row_bytes]
+    finally:
+      buf.unmap(mapinfo)
+    return buf
+
+  def stop(self):
+    self.pool.set_active(False)
+
+# Encoded frames queued in appsrc before the decoder counts as too far behind; a few seconds of 1080p
+MAX_ENCODED_BACKLOG_BYTES = 4 * 1024 * 1024
+
+# Keyframe requests repeat at this interval until one arrives; browsers don't send them periodically
+KEYFRAME_REQUEST_INTERVAL = 1.0
+
+# H.264 decoders for the "h264" ingest, best first: VA-API (new and legacy plugin), then software
+H264_DECODERS = ("vah264dec", "vaapih264dec", "avdec_h264", "openh264dec")
+
+# Sinks that can draw into a foreign window and scale/convert on the GPU, in order of preference
+RENDER_SINKS = {
+  "overlay": "xvimagesink",
+  "gl": "glimagesink",
+}
+
+# Muxers for the segmented recording branch, keyed by file extension
+RECORD_MUXERS = {
+  ".mkv": "matroskamux",
+  ".mp4": "mp4mux",
+}
+
+# What the virtual camera advertises to consumers; YUY2 at a fixed size is what
+# browsers and conferencing apps negotiate most reliably with v4l2loopback
+VIRTUAL_CAMERA_FORMAT = "YUY2"
+VIRTUAL_CAMERA_SIZE = (1280, 720)
+
+# Every element the video and audio pipelines may use. Loading their plugins ahead of
+# time takes the dlopen and registry work off the path of the first offer.
+PREWARM_ELEMENTS = (
+  "appsrc", "appsink", "tee", "queue", "valve", "videoconvert", "videoscale", "fakesink", "v4l2sink",
+  "x264enc", "h264parse", "splitmuxsink", "audioconvert", "audioresample", "volume", "pulsesink",
+)
+
+def prewarm():
+  for name in PREWARM_ELEMENTS + tuple(RENDER_SINKS.values()) + H264_DECODERS:
+    factory = Gst.ElementFactory.find(name)
+    if factory is not None:
+      factory.load()
+  can_write_mapped_buffers()
+
+@functools.lru_cache(maxsize=None)
+def can_write_mapped_buffers():
+  # The native ingest writes through Buffer.map(); only gst-python's overrides (python3-gst-1.0)
+  # hand back writable memory, plain PyGObject gives a read-only copy
+  buf = Gst.Buffer.new_allocate(None, 16, None)
+  ok, mapinfo = buf.map(Gst.MapFlags.WRITE)
+  if not ok:
+    return False
+  try:
+    writable = not memoryview(mapinfo.data).readonly
+  finally:
+    buf.unmap(mapinfo)
+  if not writable:
+    logger.warning("GStreamer buffers aren't writable from Python; install python3-gst-1.0. Using the RGB ingest")
+  return writable
+
+def watch_bus(pipeline, name, on_error=None):
+  # A sync handler runs on the posting thread, so this works without a GLib main loop;
+  # messages still reach the bus afterwards for anyone popping them
+  def on_message(bus, message):
+    if message.type == Gst.MessageType.ERROR:
+      error, debug = message.parse_error()
+      logger.error("%s pipeline error from %s: %s (%s)", name, message.src.get_name(), error.message, debug)
+      if on_error:
+        on_error()
+    elif message.type == Gst.MessageType.WARNING:
+      warning, debug = message.parse_warning()
+      logger.warning("%s pipeline warning from %s: %s (%s)", name, message.src.get_name(), warning.message, debug)
+    return Gst.BusSyncReply.PASS
+  pipeline.get_bus().set_sync_handler(on_message)
+
 class GStreamerPipeline:
-  def __init__(self, widget_win_id: int):
+  def __init__(self, widget_win_id: int, ingest: str = "native", render: str = "overlay",
+               record_path: str = None, record_segment_seconds: int = 60,
+               virtual_device: str = None, virtual_sink: str = None,
+               h264_decoder: str = None, metrics: PipelineMetrics = None,
+               preview_enabled: bool = True, virtual_camera_enabled: bool = True):
     self.widget_id = widget_win_id
+    self.metrics = metrics
+    self.ingest = ingest
+    self.render = render
+    self.record_path = record_path
+    self.record_segment_seconds = record_segment_seconds
+    self.virtual_device = virtual_device
+    self.virtual_sink = virtual_sink
+    self.h264_decoder = h264_decoder
+    self.preview_valve = None
+    self.virtual_valve = None
+    self.preview_enabled = preview_enabled
+    self.virtual_camera_enabled = virtual_camera_enabled
     self.pipeline = None
+    self.virtual_pipeline = None
+    self.virtual_src = None
+    self.virtual_failed = False
     self.appsrc = None
+    self.preview_sink = None
+    self.caps_key = None
+    self.buffer_pool = None
+    self.awaiting_keyframe = False
 
-  def build_pipeline(self):
-    pipeline_description = f"""
-      appsrc name=mysrc is-live=true block=true format=time do-timestamp=true !
+  def resolve_render(self):
+    render = self.render
+    if render == "none":
+      return render
+    if not self.widget_id:
+      return "window"
+    if render == "overlay" and Gst.ElementFactory.find(RENDER_SINKS["overlay"]) is None:
+      render = "gl"
+    if render == "gl" and Gst.ElementFactory.find(RENDER_SINKS["gl"]) is None:
+      render = "window"
+    return render
+
+  def resolve_h264_decoder(self):
+    if self.h264_decoder:
+      return self.h264_decoder
+    for name in H264_DECODERS:
+      if Gst.ElementFactory.find(name) is not None:
+        return name
+    raise RuntimeError("No H.264 decoder found, install gstreamer1.0-libav or gstreamer1.0-vaapi")
+
+  def source_description(self):
+    if self.ingest == "h264":
+      # Access units straight off the jitter buffer; decoding runs on the appsrc streaming thread.
+      # Pushed from the event loop, so appsrc never blocks and push_encoded_frame bounds the queue.
+      decoder = self.resolve_h264_decoder()
+      logger.info("Decoding H.264 with %s", decoder)
+      return f"""
+        appsrc name=mysrc is-live=true block=false max-bytes=0 format=time do-timestamp=true
+          caps=video/x-h264,stream-format=byte-stream,alignment=au !
+        h264parse ! {decoder} !
+      """
+    return "appsrc name=mysrc is-live=true block=true format=time do-timestamp=true !"
+
+  def preview_description(self):
+    render = self.resolve_render()
+    if render == "none":
+      # Headless: frames still flow to the recorder and virtual camera branches
+      return "valve name=previewvalve ! fakesink name=headless sync=false"
+    if render == "window":
+      return "valve name=previewvalve ! videoconvert ! autovideosink sync=false"
+
+    # xvimagesink only takes YUV, so the legacy RGB ingest still needs a conversion in front of it
+    convert = "videoconvert ! " if render == "overlay" and self.ingest == "rgb" else ""
+    return f"valve name=previewvalve ! {convert}{RENDER_SINKS[render]} name=preview sync=false force-aspect-ratio=true"
+
+  def virtual_camera_description(self):
+    # Scale to a fixed size so consumers never see the device caps change when the phone adapts
+    width, height = VIRTUAL_CAMERA_SIZE
+    sink = self.virtual_sink or f"v4l2sink device={self.virtual_device} sync=false"
+    return f"""
+      appsrc name=virtualsrc is-live=true format=time !
+      videoscale add-borders=true ! videoconvert !
+      video/x-raw,format={VIRTUAL_CAMERA_FORMAT},width={width},height={height},pixel-aspect-ratio=1/1 !
+      {sink}
+    """
+
+  def has_virtual_camera(self):
+    if self.virtual_sink:
+      return True
+    if not self.virtual_device:
+      return False
+    if not os.path.exists(self.virtual_device):
+      logger.warning("%s not found, is v4l2loopback loaded? Virtual camera disabled", self.virtual_device)
+      return False
+    return True
+
+  def record_description(self):
+    # e.g. recordings/stream_%05d.mkv; splitmuxsink starts a new file every segment
+    muxer = RECORD_MUXERS.get(os.path.splitext(self.record_path)[1].lower(), "matroskamux")
+    return f"""
       videoconvert !
-      queue !
-      autovideosink sync=false
+      x264enc tune=zerolatency speed-preset=ultrafast key-int-max=60 !
+      h264parse !
+      splitmuxsink location={self.record_path} muxer-factory={muxer}
+        max-size-time={self.record_segment_seconds * Gst.SECOND}
     """
+
+  def build_pipeline(self):
+    if self.ingest == "native" and not can_write_mapped_buffers():
+      self.ingest = "rgb"
+    # Each output hangs off the tee behind its own leaky queue, so a slow
+    # branch drops its own frames instead of stalling the preview
+    branches = [(2, self.preview_description())]
+    if self.record_path:
+      os.makedirs(os.path.dirname(self.record_path) or ".", exist_ok=True)
+      branches.append((30, self.record_description()))
+    if self.has_virtual_camera():
+      # Handed over to the virtual camera's own pipeline, see build_virtual_camera()
+      branches.append((2, "valve name=virtualvalve ! appsink name=virtualout emit-signals=true sync=false max-buffers=1 drop=true"))
+
+    pipeline_description = f"""
+      {self.source_description()}
+      tee name=t
+    """ + "".join(f"""
+      t. ! queue max-size-buffers={max_buffers} leaky=downstream ! {branch}
+    """ for max_buffers, branch in branches)
     self.pipeline = Gst.parse_launch(pipeline_description)
     self.appsrc = self.pipeline.get_by_name("mysrc")
+    self.preview_sink = self.pipeline.get_by_name("preview")
+    self.preview_valve = self.pipeline.get_by_name("previewvalve")
+    self.virtual_valve = self.pipeline.get_by_name("virtualvalve")
+    if self.preview_sink:
+      # Let Qt keep input events; the sink only draws into the preview widget
+      self.preview_sink.set_property("handle-events", False)
+      self.preview_sink.set_window_handle(self.widget_id)
+    virtual_out = self.pipeline.get_by_name("virtualout")
+    if virtual_out:
+      virtual_out.connect("new-sample", self.forward_virtual_sample)
+      self.build_virtual_camera()
+    watch_bus(self.pipeline, "Video")
+    # The UI may have hidden the preview or paused the camera before the first offer got here
+    self.set_preview_enabled(self.preview_enabled)
+    self.set_virtual_camera_enabled(self.virtual_camera_enabled)
     self.pipeline.set_state(Gst.State.PLAYING)
 
+  def build_virtual_camera(self):
+    # A pipeline of its own behind an appsink: a busy or mis-negotiating device errors out
+    # here instead of flowing back through the tee and stopping the preview and recording
+    self.virtual_failed = False
+    self.virtual_pipeline = Gst.parse_launch(self.virtual_camera_description())
+    self.virtual_src = self.virtual_pipeline.get_by_name("virtualsrc")
+    watch_bus(self.virtual_pipeline, "Virtual camera", on_error=self.on_virtual_camera_error)
+    self.virtual_pipeline.set_state(Gst.State.PLAYING)
+
+  def forward_virtual_sample(self, appsink):
+    sample = appsink.emit("pull-sample")
+    virtual_src = self.virtual_src
+    if sample is not None and virtual_src is not None and not self.virtual_failed:
+      virtual_src.emit("push-sample", sample)
+    return Gst.FlowReturn.OK
+
+  def on_virtual_camera_error(self):
+    # Runs on the failing streaming thread, so the pipeline is only torn down later;
+    # until then frames stop at the appsink. Re-enabling the camera tries again.
+    self.virtual_failed = True
+
+  def stop_virtual_camera(self):
+    if self.virtual_pipeline:
+      self.virtual_pipeline.set_state(Gst.State.NULL)
+    self.virtual_pipeline = None
+    self.virtual_src = None
+
+  def set_preview_enabled(self, enabled: bool):
+    # A closed valve drops buffers before the sink, so a hidden preview costs nothing to render
+    self.preview_enabled = enabled
+    if self.preview_valve:
+      self.preview_valve.set_property("drop", not enabled)
+
+  def set_virtual_camera_enabled(self, enabled: bool):
+    self.virtual_camera_enabled = enabled
+    if self.virtual_valve:
+      self.virtual_valve.set_property("drop", not enabled)
+    if enabled and self.virtual_failed:
+      logger.info("Restarting the virtual camera")
+      self.stop_virtual_camera()
+      self.build_virtual_camera()
+
+  def expose(self):
+    if self.preview_sink:
+      self.preview_sink.expose()
+
+  def set_caps(self, fmt, width, height, pooled=False):
+    if self.caps_key == (fmt, width, height):
+      return
+    caps = Gst.Caps.from_string(f"video/x-raw,format={fmt},width={width},height={height},framerate={FRAMERATE}")
+    self.appsrc.set_caps(caps)
+    self.caps_key = (fmt, width, height)
+    if self.buffer_pool:
+      self.buffer_pool.stop()
+      self.buffer_pool = None
+    # Only the native ingest copies into pooled buffers; the RGB path wraps its own bytes
+    if pooled:
+      self.buffer_pool = FrameBufferPool(caps)
+
   def push_frame(self, frame_bytes, width, height, fmt="RGB"):
     buf = Gst.Buffer.new_wrapped(frame_bytes)
-    caps = Gst.Caps.from_string(f"video/x-raw,format={fmt},width={width},height={height},framerate=30/1")
-    self.appsrc.set_caps(caps)
+    self.set_caps(fmt, width, height)
     self.appsrc.emit("push-buffer", buf)
 
+  def push_encoded_frame(self, frame: EncodedVideoFrame):
+    # Every access unit has to reach the decoder: a skipped P-frame corrupts the picture until
+    # the next IDR. Only when the decoder is this far behind are frames given up, up to an IDR.
+    if self.awaiting_keyframe:
+      if not is_h264_keyframe(frame.data):
+        return False
+      self.awaiting_keyframe = False
+    elif self.appsrc.get_property("current-level-bytes") > MAX_ENCODED_BACKLOG_BYTES:
+      logger.warning("H.264 decoder is falling behind, skipping to the next key frame")
+      self.awaiting_keyframe = True
+      return False
+    with timed(self.metrics, "render"):
+      self.appsrc.emit("push-buffer", Gst.Buffer.new_wrapped(frame.data))
+    return True
+
+  def push_video_frame(self, frame: VideoFrame):
+    if isinstance(frame, EncodedVideoFrame):
+      self.push_encoded_frame(frame)
+      return
+    if self.ingest == "rgb":
+      with timed(self.metrics, "convert"):
+        img = frame.to_ndarray(format="rgb24")
+        frame_bytes = img.tobytes()
+      with timed(self.metrics, "render"):
+        self.push_frame(frame_bytes, frame.width, frame.height)
+      return
+
+    with timed(self.metrics, "convert"):
+      fmt = NATIVE_FORMATS.get(frame.format.name)
+      if fmt is None:
+        frame = frame.reformat(format="yuv420p")
+        fmt = "I420"
+      self.set_caps(fmt, frame.width, frame.height, pooled=True)
+      buf = self.buffer_pool.fill(frame)
+    if buf is not None:
+      with timed(self.metrics, "render"):
+        self.appsrc.emit("push-buffer", buf)
+
   def stop(self):
+    if self.pipeline and self.record_path:
+      # Let the muxer write its index before tearing down, otherwise the last segment is unplayable
+      self.appsrc.emit("end-of-stream")
+      self.pipeline.get_bus().timed_pop_filtered(2 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
     if self.pipeline:
       self.pipeline.set_state(Gst.State.NULL)
+    self.stop_virtual_camera()
+    if self.buffer_pool:
+      self.buffer_pool.stop()
+      self.buffer_pool = None
+    self.caps_key = None
+    self.awaiting_keyframe = False
 
 class WebRTCWorker(QObject):
   video_frame_received = pyqtSignal(object)
   connection_state_changed = pyqtSignal(str)
+  metrics_updated = pyqtSignal(dict)
 
-  def __init__(self, code: str, widget_win_id: int, offer):
+  def __init__(self, code: str, widget_win_id: int, offer, render: str = "overlay",
+               recorder: FrameRecorder = None, record_path: str = None,
+               virtual_device: str = None, virtual_sink: str = None,
+               metrics_server: MetricsServer = None, metrics_interval: float = 1.0,
+               audio_pipeline: AudioPipeline = None, codecs=None, decode: str = "software",
+               h264_decoder: str = None, adaptive_quality: bool = True, reconnect_timeout: float = 15.0,
+               preview_enabled: bool = True, virtual_camera_enabled: bool = True):
     super().__init__()
     self.code = code
     self.offer = offer
     self.pc = None
+    self.loop = None
+    self.run_future = None
+    self.stopped = asyncio.Event()
+    self.tasks = []
     self.running = False
-    self.gst_pipeline = GStreamerPipeline(widget_win_id)
+    self.recorder = recorder
+    self.audio_pipeline = audio_pipeline
+    self.audio_built = None
+    self.metrics = PipelineMetrics(session=code)
+    self.metrics_server = metrics_server
+    self.metrics_interval = metrics_interval
+    self.codecs = codecs
+    self.decode = decode
+    self.quality = QualityController() if adaptive_quality else None
+    self.quality_target = None
+    self.control_channel = None
+    self.rtt_ms = None
+    self.video_codec = None
+    self.revision = 0
+    self.reconnect_timeout = reconnect_timeout
+    self.reconnect_deadline = None
+    self.reconnect_started = None
+    self.keyframe_requested_at = None
+    self.code_deleted = False
+    self.software_decoder = None
+    if recorder and decode == "gstreamer":
+      logger.warning("JPEG recording only sees VP8 frames when GStreamer decodes H.264")
+    if recorder:
+      recorder.metrics = self.metrics
+    self.signaling = SignalingClient()
+    self.mailbox = LatestFrameMailbox()
+    self.frame_consumers = {}
+    if recorder:
+      self.add_frame_consumer("record", recorder.submit)
+    self.render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+    self.gst_pipeline = GStreamerPipeline(
+      widget_win_id,
+      render=render,
+      record_path=record_path,
+      virtual_device=virtual_device,
+      virtual_sink=virtual_sink,
+      h264_decoder=h264_decoder,
+      metrics=self.metrics,
+      preview_enabled=preview_enabled,
+      virtual_camera_enabled=virtual_camera_enabled,
+    )
+
+  def add_frame_consumer(self, name, callback):
+    # callback(frame) runs on the worker's event loop for the newest frame whenever it gets a turn; keep it cheap
+    self.frame_consumers[name] = callback
 
-  def start(self):
+  def start(self, loop: asyncio.AbstractEventLoop = None):
+    # With a loop the session shares it with other sessions; otherwise it gets a thread and loop of its own
     self.running = True
-    threading.Thread(target=self._run_async_thread, daemon=True).start()
+    if loop:
+      self.loop = loop
+      self.run_future = asyncio.run_coroutine_threadsafe(self._run(), loop)
+    else:
+      threading.Thread(target=self._run_async_thread, daemon=True).start()
 
   def stop(self):
     self.running = False
-    if self.pc:
-      asyncio.run_coroutine_threadsafe(self.pc.close(), asyncio.get_event_loop())
-    self.gst_pipeline.stop()
+    # Everything is torn down by _run on the worker's loop once stopped is set, after the
+    # tasks still pushing into the pipelines have been cancelled
+    if self.loop:
+      self.loop.call_soon_threadsafe(self.stopped.set)
+
+  def wait_closed(self, timeout=None):
+    # After stop(), for a shared loop that's about to be stopped: lets _run close the peer connection first
+    if self.run_future is None:
+      return
+    try:
+      self.run_future.result(timeout)
+    except Exception as e:
+      logger.warning("Session %s didn't shut down cleanly: %r", self.code, e)
 
   def _run_async_thread(self):
     asyncio.run(self._run())
 
   async def _run(self):
-    self.pc = RTCPeerConnection()
+    self.loop = asyncio.get_running_loop()
+    try:
+      await self.stream()
+    finally:
+      await self.shutdown()
+
+  async def stream(self):
+    if not self.running:
+      return
+    if not self.offer:
+      self.connection_state_changed.emit("failed")
+      return
 
-    @self.pc.on("connectionstatechange")
+    if self.recorder and self.recorder.policy == "keyframe-only":
+      enable_keyframe_tagging()
+    await self.connect(self.offer)
+
+    self.video_codec = negotiated_codec(self.pc.localDescription.sdp)
+    if self.video_codec:
+      logger.info("Negotiated %s video", self.video_codec)
+      if self.video_codec == "H264" and self.decode == "gstreamer":
+        self.gst_pipeline.ingest = "h264"
+      # Built while ICE and DTLS finish, so it's ready before the first frame arrives
+      try:
+        self.gst_pipeline.build_pipeline()
+      except Exception as e:
+        logger.error("Failed to build video pipeline: %s", e)
+        if self.gst_pipeline.ingest == "h264":
+          logger.warning("Falling back to decoding H.264 with PyAV")
+          self.gst_pipeline.stop()
+          self.gst_pipeline.ingest = "native"
+          try:
+            self.gst_pipeline.build_pipeline()
+          except Exception as e:
+            logger.error("Failed to build video pipeline: %s", e)
+      if self.gst_pipeline.ingest == "h264":
+        # aiortc picks the decoder when the first frame arrives, so this still covers the session.
+        # Only switched on once the pipeline exists, as it applies to every session in the process.
+        enable_h264_passthrough()
+    # Outputs read from the mailbox, so they carry on unchanged when a reconnect swaps the track feeding it.
+    # Encoded H.264 is the exception: it can't skip frames, so receive_frames pushes it in order itself.
+    if self.gst_pipeline.ingest != "h264":
+      self.spawn(self.render_frames())
+    for name, callback in self.frame_consumers.items():
+      self.spawn(self.consume_frames(name, callback))
+    if self.metrics_server:
+      self.metrics_server.register(self.metrics)
+    self.spawn(self.report_metrics())
+    self.spawn(self.watch_for_reoffers())
+
+    # Keep the session's tasks alive until stop(); on a shared loop nothing else would cancel them
+    await self.stopped.wait()
+
+  async def shutdown(self):
+    for task in self.tasks:
+      task.cancel()
+    await asyncio.gather(*self.tasks, return_exceptions=True)
+    if self.reconnect_deadline:
+      self.reconnect_deadline.cancel()
+    if self.audio_built:
+      await asyncio.gather(self.audio_built, return_exceptions=True)
+    self.mailbox.close()
+    logger.info("Video stats: %s", self.mailbox.stats())
+    if self.metrics_server:
+      self.metrics_server.unregister(self.metrics)
+    if self.pc:
+      await self.pc.close()
+    await self.signaling.close()
+    # Blocks on the render thread's last push, the muxer's EOS, pactl and the JPEG writers
+    await self.loop.run_in_executor(None, self.close_outputs)
+
+  def close_outputs(self):
+    # The render thread may still be inside a push; let it finish before the pipeline goes
+    self.render_executor.shutdown(wait=True)
+    self.gst_pipeline.stop()
+    if self.audio_pipeline:
+      self.audio_pipeline.stop()
+    if self.recorder:
+      self.recorder.stop()
+
+  async def connect(self, offer):
+    # One peer connection per offer. aiortc can't restart ICE in place, so a re-offer gets a
+    # new one; everything downstream of the mailbox (pipelines, virtual devices) is kept.
+    pc = RTCPeerConnection()
+    previous, self.pc = self.pc, pc
+
+    @pc.on("connectionstatechange")
     async def on_connectionstatechange():
-      state = self.pc.connectionState
-      print(f"[WebRTC] State: {state}")
-      self.connection_state_changed.emit(state)
+      # A replaced connection reports "closed" on its way out; only the current one speaks for the session
+      if pc is self.pc:
+        self.on_connection_state(pc.connectionState)
 
-    @self.pc.on("track")
+    @pc.on("datachannel")
+    def on_datachannel(channel):
+      # The phone opens "control" before its offer; quality targets go back over it
+      if channel.label == "control":
+        self.control_channel = channel
+        channel.on("message", self.on_control_message)
+        if self.quality_target:
+          # A reconnected phone starts from its own settings again
+          self.send_control(quality_message(self.quality_target))
+
+    @pc.on("track")
     def on_track(track):
-      print(f"[WebRTC] Track received: {track.kind}")
+      logger.info("Track received: %s", track.kind)
       if track.kind == "video":
-        # asyncio.ensure_future(self.consume_video(track))
-        asyncio.ensure_future(self.handle_track(track))
+        self.spawn(self.receive_frames(track, pc))
+      elif track.kind == "audio" and self.audio_pipeline:
+        self.spawn(self.consume_audio(track, pc))
 
-    offer = self.offer
-    if not offer:
-      self.connection_state_changed.emit("failed")
-      return
+    if previous:
+      # The phone only re-offers once it has given up on the old connection
+      await previous.close()
+    if self.codecs:
+      # setRemoteDescription picks this transceiver up for the offer's video m-line, preferences included
+      pc.addTransceiver("video", direction="recvonly").setCodecPreferences(codec_preferences(self.codecs))
+
+    await pc.setRemoteDescription(RTCSessionDescription(**offer))
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+    # aiortc can't trickle its own candidates (they're gathered inside setLocalDescription),
+    # so the answer goes out as soon as that returns and the phone's candidates trickle in
+    await self.send_answer(pc.localDescription)
+    self.spawn(self.receive_remote_candidates(pc))
+
+  def on_connection_state(self, state):
+    logger.info("State: %s", state)
+    # aiortc also reports "closed" when the phone closes its end; only stop() really ends the session
+    if state in ("disconnected", "failed") or (state == "closed" and self.running):
+      if self.code_deleted:
+        # Nothing can re-offer on a deleted code
+        state = "failed"
+      else:
+        # Give the phone time to re-offer on the same code before reporting the session as lost
+        if self.reconnect_deadline is None:
+          self.reconnect_deadline = self.loop.call_later(self.reconnect_timeout, self.give_up_reconnecting)
+        state = "reconnecting"
+    elif state == "connected":
+      if self.reconnect_deadline:
+        self.reconnect_deadline.cancel()
+        self.reconnect_deadline = None
+      if self.reconnect_started is not None:
+        self.metrics.observe("reconnect", (time.perf_counter() - self.reconnect_started) * 1000)
+        self.reconnect_started = None
+    self.connection_state_changed.emit(state)
 
-    await self.pc.setRemoteDescription(RTCSessionDescription(**offer))
-    answer = await self.pc.createAnswer()
-    await self.pc.setLocalDescription(answer)
-    await self.send_answer(self.pc.localDescription)
+  def give_up_reconnecting(self):
+    logger.warning("No re-offer within %ds, giving up", self.reconnect_timeout)
+    self.reconnect_deadline = None
+    self.connection_state_changed.emit("failed")
+
+  async def watch_for_reoffers(self):
+    while self.running:
+      try:
+        data = await self.signaling.wait_for_offer(self.code, since=self.revision)
+      except SignalingError as e:
+        if e.status == 404:
+          # The code was deleted, so no re-offer can come; the session ends with its current connection
+          logger.info("Code %s is gone, no longer waiting for re-offers", self.code)
+          self.code_deleted = True
+          if self.reconnect_deadline:
+            self.reconnect_deadline.cancel()
+            self.reconnect_deadline = None
+            self.connection_state_changed.emit("failed")
+          return
+        logger.debug("Waiting for a re-offer failed: %s", e)
+        await asyncio.sleep(1)
+        continue
+      except Exception as e:
+        logger.debug("Waiting for a re-offer failed: %s", e)
+        await asyncio.sleep(1)
+        continue
+      if not data or data.get("revision", 0) <= self.revision:
+        continue
+
+      self.revision = data["revision"]
+      self.reconnect_started = time.perf_counter()
+      logger.info("Re-offer %d received, reconnecting", self.revision)
+      await self.connect(data["offer"])
+      codec = negotiated_codec(self.pc.localDescription.sdp)
+      if codec != self.video_codec:
+        logger.warning("Re-offer negotiated %s after %s; the video pipeline keeps its %s input",
+                       codec, self.video_codec, self.gst_pipeline.ingest)
+
+  def spawn(self, coro):
+    task = asyncio.ensure_future(coro)
+    task.add_done_callback(self.log_task_error)
+    self.tasks.append(task)
+    return task
+
+  def log_task_error(self, task):
+    if not task.cancelled() and task.exception():
+      logger.error("Task %s failed", task.get_coro().__name__, exc_info=task.exception())
 
   async def send_answer(self, sdp):
     try:
-      res = requests.post(
-        "https://submitanswer-qaf2yvcrrq-uc.a.run.app",
-        json={
-          "code": self.code,
-          "answer": {
-            "sdp": sdp.sdp,
-            "type": sdp.type
-          }
-        },
-        timeout=10
-      )
-      if res.status_code == 200:
-        print("[WebRTC] Answer submitted successfully")
-      else:
-        print(f"[WebRTC] Answer submission failed: {res.status_code}")
+      await self.signaling.submit_answer(self.code, {"sdp": sdp.sdp, "type": sdp.type})
+      logger.info("Answer submitted successfully")
+    except Exception as e:
+      logger.error("Answer error: %s", e)
+
+  async def receive_remote_candidates(self, pc):
+    since = 0
+    while self.running and pc is self.pc and pc.connectionState not in ("connected", "closed", "failed"):
+      try:
+        candidates, complete = await self.signaling.wait_for_candidates(self.code, since)
+      except SignalingError as e:
+        if e.endpoint_missing:
+          # Older signaling backends don't trickle; the offer SDP then carries all candidates
+          logger.info("Remote candidate trickle unavailable: %s", e)
+          return
+        # The phone's offer goes out before its candidates, so giving up here could leave ICE with none
+        logger.warning("Waiting for remote candidates failed, retrying: %s", e)
+        await asyncio.sleep(1)
+        continue
+
+      since += len(candidates)
+      for candidate in candidates:
+        await self.add_remote_candidate(pc, candidate)
+      if complete:
+        await self.end_remote_candidates(pc)
+        logger.info("Received all %d remote candidates", since)
+        return
+
+  async def end_remote_candidates(self, pc):
+    try:
+      await pc.addIceCandidate(None)
+    except AttributeError:
+      # Older aiortc (e.g. 1.11) reads sdpMid off the candidate; tell each ICE transport directly
+      transports = {transceiver.receiver.transport.transport for transceiver in pc.getTransceivers()}
+      if pc.sctp:
+        transports.add(pc.sctp.transport.transport)
+      for transport in transports:
+        await transport.addRemoteCandidate(None)
+
+  async def add_remote_candidate(self, pc, candidate):
+    sdp = candidate.get("candidate") or ""
+    if not sdp:
+      return
+    try:
+      ice_candidate = candidate_from_sdp(sdp.split(":", 1)[1] if sdp.startswith("candidate:") else sdp)
+      ice_candidate.sdpMid = candidate.get("sdpMid")
+      ice_candidate.sdpMLineIndex = candidate.get("sdpMLineIndex")
+      await pc.addIceCandidate(ice_candidate)
     except Exception as e:
-      print(f"[WebRTC] Answer error: {e}")
+      logger.warning("Ignoring remote candidate %r: %s", sdp, e)
 
-  async def consume_video(self, track: MediaStreamTrack):
-    print("[WebRTC] Starting video track consumption")
-    self.gst_pipeline.build_pipeline()
+  async def report_metrics(self):
+    previous = None
+    stats_pc = None
     while self.running:
+      await asyncio.sleep(self.metrics_interval)
+      if self.pc is not stats_pc:
+        # A reconnect starts the peer counters from zero again
+        stats_pc, previous = self.pc, None
+        self.rtt_ms = None
+        if self.quality:
+          self.quality.reset()
       try:
-        frame: VideoFrame = await track.recv()
-        img = frame.to_ndarray(format="rgb24")
-        self.gst_pipeline.push_frame(img.tobytes(), frame.width, frame.height)
+        previous = await collect_peer_stats(self.pc, previous)
       except Exception as e:
-        print(f"[WebRTC] Video track ended: {e}")
-        break
-   
-  async def handle_track(self, track: MediaStreamTrack):
-    print("Inside handle track")
-    self.track = track
-    frame_count = 0
-    while True:
+        logger.debug("getStats failed: %s", e)
+        continue
+
+      # The phone echoes this back as a pong; that's the only RTT a receive-only peer can get
+      self.send_control(json.dumps({"type": "ping", "sent": time.perf_counter()}))
+      frames = self.mailbox.stats()
+      if self.quality:
+        target = self.quality.update(previous, frames)
+        if target:
+          self.quality_target = target
+          self.send_control(quality_message(target))
+      with self.metrics.lock:
+        if self.quality:
+          self.metrics.quality = self.quality.target()
+        self.metrics.peer = {name: previous[name] for name in ("bitrate_kbps", "jitter_ms", "loss_rate", "packets_lost")}
+        self.metrics.peer["rtt_ms"] = self.rtt_ms
+        self.metrics.frames = {"received": frames["received"]}
+        for name, counters in frames["consumers"].items():
+          self.metrics.frames[f"{name}_delivered"] = counters["delivered"]
+          self.metrics.frames[f"{name}_dropped"] = counters["dropped"]
+      snapshot = self.metrics.snapshot()
+      logger.debug("Metrics: %s", snapshot)
+      self.metrics_updated.emit(snapshot)
+
+  def on_control_message(self, message):
+    try:
+      data = json.loads(message)
+    except ValueError:
+      return
+    if data.get("type") == "pong":
+      # Round trip over the same ICE path as the media, plus the phone's event loop
+      self.rtt_ms = (time.perf_counter() - data["sent"]) * 1000
+
+  def send_control(self, message):
+    if self.control_channel is None or self.control_channel.readyState != "open":
+      logger.debug("No control channel, dropping %s", message)
+      return
+    self.control_channel.send(message)
+
+  async def consume_audio(self, track: MediaStreamTrack, pc):
+    # Audio can't skip ahead like video, so every decoded frame goes straight to appsrc;
+    # the pipeline's leaky queue bounds the buffering instead
+    logger.info("Starting audio track consumption")
+    if self.audio_built is None:
+      # Built once per session, off the loop: pactl runs in here and would stall every session sharing it
+      self.audio_built = asyncio.get_running_loop().run_in_executor(None, self.audio_pipeline.build_pipeline)
+    await self.audio_built
+    try:
+      while self.running and pc is self.pc:
+        self.audio_pipeline.push_audio_frame(await track.recv())
+    except Exception as e:
+      logger.info("Audio track ended: %s", e)
+
+  async def receive_frames(self, track: MediaStreamTrack, pc):
+    # Never does anything but drain the track, so aiortc's queue can't back up behind a slow consumer
+    logger.info("Starting video track consumption")
+    try:
+      while self.running and pc is self.pc:
+        frame = await track.recv()
+        if isinstance(frame, EncodedVideoFrame):
+          if self.gst_pipeline.ingest == "h264":
+            self.push_encoded_frame(frame, pc)
+          else:
+            for decoded in await self.decode_in_software(frame):
+              self.mailbox.put(decoded)
+            continue
+        self.mailbox.put(frame)
+    except Exception as e:
+      logger.info("Video track ended: %s", e)
+
+  async def decode_in_software(self, frame: EncodedVideoFrame):
+    # Passthrough stays on for the whole process once another session enabled it, so a session
+    # whose H.264 pipeline couldn't be built decodes here instead, on the render thread to keep order
+    if self.software_decoder is None:
+      logger.warning("Decoding passed-through H.264 with PyAV")
+      self.software_decoder = H264Decoder()
+    loop = asyncio.get_running_loop()
+    try:
+      return await loop.run_in_executor(
+        self.render_executor, self.software_decoder.decode, JitterFrame(frame.data, frame.pts)
+      )
+    except Exception as e:
+      logger.error("Decode error: %s", e)
+      return []
+
+  def push_encoded_frame(self, frame: EncodedVideoFrame, pc):
+    # Only queues the buffer in appsrc, so it's cheap enough to run on the loop
+    try:
+      pushed = self.gst_pipeline.push_encoded_frame(frame)
+    except Exception as e:
+      logger.error("Render error: %s", e)
+      return
+    # Counted like the mailbox's render consumer, so skipped frames still read as CPU pressure
+    self.mailbox.count("render", dropped=not pushed)
+    if pushed:
+      self.keyframe_requested_at = None
+      return
+    now = time.monotonic()
+    if self.keyframe_requested_at is None or now - self.keyframe_requested_at > KEYFRAME_REQUEST_INTERVAL:
+      self.keyframe_requested_at = now
+      self.spawn(self.request_keyframe(pc))
+
+  async def request_keyframe(self, pc):
+    # aiortc only sends a PLI on packet loss it notices itself and has no public call for it
+    for receiver in pc.getReceivers():
+      if receiver.track and receiver.track.kind == "video":
+        for source in receiver.getSynchronizationSources():
+          await receiver._send_rtcp_pli(source.source)
+
+  async def render_frames(self):
+    # Pushing runs on its own thread so receive_frames keeps draining while a frame is copied in
+    loop = asyncio.get_running_loop()
+    async for frame in self.mailbox.subscribe("render"):
       try:
-        print("Waiting for frame...")
-        frame = await asyncio.wait_for(track.recv(), timeout=5.0)
-        frame_count += 1
-        print(f"Received frame {frame_count}")
-        
-        if isinstance(frame, VideoFrame):
-          print(f"Frame type: VideoFrame, pts: {frame.pts}, time_base: {frame.time_base}")
-          frame = frame.to_ndarray(format="bgr24")
-        elif isinstance(frame, np.ndarray):
-          print(f"Frame type: numpy array")
-        else:
-          print(f"Unexpected frame type: {type(frame)}")
-          continue
-       
-         # Add timestamp to the frame
-        current_time = datetime.now()
-        new_time = current_time - timedelta( seconds=55)
-        timestamp = new_time.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        cv2.putText(frame, timestamp, (10, frame.shape[0] - 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
-        cv2.imwrite(f"imgs/received_frame_{frame_count}.jpg", frame)
-        print(f"Saved frame {frame_count} to file")
-        cv2.imshow("Frame", frame)
-  
-        # Exit on 'q' key press
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-          break
-      except asyncio.TimeoutError:
-        print("Timeout waiting for frame, continuing...")
+        await loop.run_in_executor(self.render_executor, self.gst_pipeline.push_video_frame, frame)
+      except Exception as e:
+        logger.error("Render error: %s", e)
+
+  async def consume_frames(self, name, callback):
+    async for frame in self.mailbox.subscribe(name):
+      try:
+        callback(frame)
       except Exception as e:
-        print(f"Error in handle_track: {str(e)}")
-        if "Connection" in str(e):
-          break
-    print("Exiting handle_track")
\ No newline at end of file
+        logger.error("%s consumer error: %s", name, e)
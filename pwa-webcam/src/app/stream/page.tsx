@@ -41,6 +41,7 @@ export default function StreamPage() {
   });
   
   const peerConnectionRef = useRef<RTCPeerConnection | null>(null);
+  const stopNetworkWatchRef = useRef<(() => void) | null>(null);
 
   const [fps, setFps] = useState<"30" | "60">("60");
   const [resolution, setResolution] = useState<"sd" | "hd" | "4k">("hd");
@@ -49,7 +50,7 @@ export default function StreamPage() {
   const [connectionStatus, setConnectionStatus] = useState<ConnectionState>("connecting");
   const [errorMessage, setErrorMessage] = useState<string | null>(null);
 
-  // TODO: setupWebRTC, renegotiateConnection, toggleStream, handBack, toggleVideo, toggleMic, handleCameraFlip
+  // TODO: setupWebRTC, toggleStream, handBack, toggleVideo, toggleMic, handleCameraFlip
   
   useEffect(() => {
     if (!isLoadingMedia && media) {
@@ -70,30 +71,91 @@ export default function StreamPage() {
     let peerConnection: RTCPeerConnection;
     let sdpOffer: RTCSessionDescription | null = null;
     let backoffDelay = 2000;
+    let iceServers: RTCIceServer[] | null = null;
+    let statsTimer: ReturnType<typeof setInterval> | undefined;
+    let answered = false;
+    let reconnecting = false;
   
-    const waitForIceGathering = () =>
-      new Promise<void>((resolve) => {
-        if (peerConnection.iceGatheringState === "complete") return resolve();
-        const check = () => {
-          if (peerConnection.iceGatheringState === "complete") {
-            peerConnection.removeEventListener("icegatheringstatechange", check);
-            resolve();
-          }
-        };
-        peerConnection.addEventListener("icegatheringstatechange", check);
-      });
-  
-    const init = async () => {
-      const response = await fetch("https://getturncredentials-qaf2yvcrrq-uc.a.run.app", { method: "POST" });
-      if (!response.ok) {
-        console.error("Failed to fetch ICE servers");
-        setErrorMessage("Failed to fetch ICE servers");
+    // Trickle ICE: candidates are sent as they're gathered instead of waiting for gathering to complete.
+    // Anything found before the offer is submitted is held back so the desktop always sees the offer first.
+    let offerSubmitted = false;
+    let pendingCandidates: RTCIceCandidateInit[] = [];
+    let candidatesComplete = false;
+    // Batches go out one at a time: the desktop stops listening at `complete`, so that POST must land last
+    let candidateQueue: Promise<void> = Promise.resolve();
+
+    const flushCandidates = () => {
+      candidateQueue = candidateQueue.then(sendCandidates);
+      return candidateQueue;
+    };
+
+    const sendCandidates = async () => {
+      if (!offerSubmitted || (pendingCandidates.length === 0 && !candidatesComplete)) return;
+      const candidates = pendingCandidates;
+      pendingCandidates = [];
+      try {
+        await fetch("https://addcandidates-qaf2yvcrrq-uc.a.run.app", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ code: sessionCode, candidates, complete: candidatesComplete }),
+        });
+      } catch (err) {
+        console.error("Failed to send ICE candidates:", err);
+      }
+    };
+
+    // The desktop sends encoder targets over the "control" data channel when it or the network falls behind:
+    // a lower resolution under CPU pressure, a lower frame rate and bitrate cap under bandwidth pressure
+    const applyQualityTarget = async (target: { scaleResolutionDownBy?: number; maxFramerate?: number; maxBitrateKbps?: number }) => {
+      const sender = peerConnection.getSenders().find((s) => s.track?.kind === "video");
+      if (!sender) return;
+      const params = sender.getParameters();
+      if (!params.encodings || params.encodings.length === 0) params.encodings = [{}];
+      const encoding = params.encodings[0];
+      encoding.scaleResolutionDownBy = target.scaleResolutionDownBy ?? 1;
+      if (target.maxFramerate) encoding.maxFramerate = target.maxFramerate;
+      else delete encoding.maxFramerate;
+      if (target.maxBitrateKbps) encoding.maxBitrate = target.maxBitrateKbps * 1000;
+      else delete encoding.maxBitrate;
+
+      try {
+        await sender.setParameters(params);
+        console.log("Quality target applied:", target);
+      } catch (err) {
+        console.warn("Failed to apply quality target:", err);
+      }
+    };
+
+    const handleControlMessage = (channel: RTCDataChannel, data: string) => {
+      let message;
+      try {
+        message = JSON.parse(data);
+      } catch {
         return;
       }
-      const { iceServers } = await response.json();
+      if (message.type === "ping") {
+        // Echoed straight back: as a pure receiver the desktop has no RTCP round trip to measure
+        channel.send(JSON.stringify({ ...message, type: "pong" }));
+      } else if (message.type === "quality") {
+        applyQualityTarget(message);
+      }
+    };
+
+    const init = async () => {
+      // Fetched once per stream; a reconnect reuses them so it doesn't wait on another round trip
+      if (!iceServers) {
+        const response = await fetch("https://getturncredentials-qaf2yvcrrq-uc.a.run.app", { method: "POST" });
+        if (!response.ok) {
+          console.error("Failed to fetch ICE servers");
+          setErrorMessage("Failed to fetch ICE servers");
+          return;
+        }
+        iceServers = (await response.json()).iceServers;
+      }
 
-      peerConnection = new RTCPeerConnection({ iceServers });
+      peerConnection = new RTCPeerConnection({ iceServers: iceServers || undefined });
       peerConnectionRef.current = peerConnection;
+      watchConnection(peerConnection);
 
       if (!media) {
         console.error("No media stream available");
@@ -109,6 +171,10 @@ export default function StreamPage() {
         }
       });
       
+      // Created before the offer so it's negotiated along with the media
+      const controlChannel = peerConnection.createDataChannel("control");
+      controlChannel.onmessage = (event) => handleControlMessage(controlChannel, event.data);
+
       peerConnection.getTransceivers().forEach((t, i) => {
         console.log(`[Transceiver ${i}] kind: ${t.sender.track?.kind}, direction: ${t.direction}`);
       });      
@@ -120,7 +186,11 @@ export default function StreamPage() {
       peerConnection.onicecandidate = (event) => {
         if (event.candidate) {
           console.log("ICE candidate:", event.candidate);
+          pendingCandidates.push(event.candidate.toJSON());
+        } else {
+          candidatesComplete = true;
         }
+        flushCandidates();
       };
 
       if (!media || media.getTracks().length === 0) {
@@ -131,7 +201,8 @@ export default function StreamPage() {
       const offer = await peerConnection.createOffer();
       await peerConnection.setLocalDescription(offer);
 
-      setInterval(async () => {
+      clearInterval(statsTimer);
+      statsTimer = setInterval(async () => {
         const stats = await peerConnection.getStats();
         stats.forEach(report => {
           if (report.type === "outbound-rtp" && report.kind === "video") {
@@ -143,12 +214,21 @@ export default function StreamPage() {
         });
       }, 3000);      
 
-      await waitForIceGathering();
-  
       sdpOffer = peerConnection.localDescription;
       console.log("SDP offer created:", sdpOffer);
     };
   
+    const offerMetadata = () => ({
+      mic: isMicOn === "on",
+      webcam: isVidOn === "on",
+      resolution,
+      fps,
+      platform: "mobile",
+      facingMode: isFrontCamera ? "user" : "environment",
+      exposureLevel: exposure,
+      timestamp: Date.now(),
+    });
+
     const submitOffer = async () => {
       const response = await fetch("https://submitoffer-qaf2yvcrrq-uc.a.run.app", {
         method: "POST",
@@ -156,16 +236,7 @@ export default function StreamPage() {
         body: JSON.stringify({
           code: sessionCode,
           offer: sdpOffer,
-          metadata: {
-            mic: isMicOn === "on",
-            webcam: isVidOn === "on",
-            resolution,
-            fps,
-            platform: "mobile",
-            facingMode: isFrontCamera ? "user" : "environment",
-            exposureLevel: exposure,
-            timestamp: Date.now(),
-          },
+          metadata: offerMetadata(),
         }),
       });
 
@@ -177,12 +248,93 @@ export default function StreamPage() {
       } else {
         console.log("✅ Offer submitted successfully");
       }
+
+      offerSubmitted = true;
+      await flushCandidates();
     };
   
+    // Re-offers on the same code; the desktop answers with a new peer connection but keeps its
+    // pipelines and virtual camera, so nothing downstream notices the reconnect
+    const updateOffer = async () => {
+      const response = await fetch("https://updateoffer-qaf2yvcrrq-uc.a.run.app", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          code: sessionCode,
+          offer: sdpOffer,
+          candidates: [],
+          metadata: offerMetadata(),
+        }),
+      });
+      if (!response.ok) {
+        throw new Error("Failed to update offer");
+      }
+      offerSubmitted = true;
+      await flushCandidates();
+    };
+
+    const reconnect = async () => {
+      if (reconnecting || !answered || !peerConnectionRef.current) return;
+      reconnecting = true;
+      console.log("🔄 Connection lost, re-offering on", sessionCode);
+      setConnectionStatus("connecting");
+      const previous = peerConnection;
+      try {
+        offerSubmitted = false;
+        pendingCandidates = [];
+        candidatesComplete = false;
+        backoffDelay = 2000;
+        await init();
+        // The desktop drops the old connection as soon as it sees the re-offer
+        previous.close();
+        await createOffer();
+        await updateOffer();
+        await pollTimer();
+      } catch (err) {
+        console.error("Reconnect failed, retrying:", err);
+        setTimeout(() => {
+          reconnecting = false;
+          reconnect();
+        }, 1000);
+        return;
+      }
+      reconnecting = false;
+    };
+
+    const watchConnection = (pc: RTCPeerConnection) => {
+      pc.onconnectionstatechange = () => {
+        if (pc !== peerConnection) return;
+        console.log("Connection state:", pc.connectionState);
+        if (pc.connectionState === "connected") {
+          setConnectionStatus("connected");
+        } else if (pc.connectionState === "disconnected" || pc.connectionState === "failed") {
+          reconnect();
+        }
+      };
+    };
+
+    // A Wi-Fi roam or a switch to mobile data changes the phone's address. Re-offer straight away
+    // instead of waiting several seconds for ICE to notice the old path is gone.
+    const connection = (navigator as any).connection;
+    let networkType = connection?.type;
+    const onNetworkTypeChange = () => {
+      if (connection.type === networkType) return;
+      networkType = connection.type;
+      reconnect();
+    };
+    connection?.addEventListener("change", onNetworkTypeChange);
+    window.addEventListener("online", reconnect);
+    stopNetworkWatchRef.current = () => {
+      connection?.removeEventListener("change", onNetworkTypeChange);
+      window.removeEventListener("online", reconnect);
+      clearInterval(statsTimer);
+    };
+
     const addAnswer = async (answer: string) => {
       const parsed = JSON.parse(answer);
       if (!peerConnection.currentRemoteDescription) {
         await peerConnection.setRemoteDescription(parsed);
+        answered = true;
         console.log("✅ Remote SDP answer set");
         setConnectionStatus("connected");
         setIsStreamOn(true);
@@ -206,7 +358,34 @@ export default function StreamPage() {
       return false;
     };
   
+    // Long-poll: resolves the moment the desktop submits its answer. Returns null if the endpoint is unavailable
+    const waitForAnswer = async (): Promise<boolean | null> => {
+      try {
+        const response = await fetch("https://waitforanswer-qaf2yvcrrq-uc.a.run.app", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ code: sessionCode, timeout: 25 }),
+        });
+        if (response.status === 204) return false;
+        if (!response.ok) return null;
+
+        const data = await response.json();
+        if (!data.answer) return false;
+        await addAnswer(JSON.stringify(data.answer));
+        return true;
+      } catch (err) {
+        console.warn("Long-poll for answer failed, falling back to polling:", err);
+        return null;
+      }
+    };
+
     const pollTimer = async () => {
+      while (true) {
+        const gotAnswer = await waitForAnswer();
+        if (gotAnswer === true) return;
+        if (gotAnswer === null) break;
+      }
+
       while (true) {
         const gotAnswer = await pollForAnswer();
         if (gotAnswer) break;
@@ -229,6 +408,10 @@ export default function StreamPage() {
   };
 
   const stopStream = useCallback(() => {
+    if (stopNetworkWatchRef.current) {
+      stopNetworkWatchRef.current();
+      stopNetworkWatchRef.current = null;
+    }
     if (peerConnectionRef.current) {
       peerConnectionRef.current.close();
       peerConnectionRef.current = null;